@@ -1,22 +1,128 @@
 from hashlib import sha256
-import json
 import time
+import codec
+from difficulty import POW_LIMIT
+from merkle import merkle_root, merkle_proof
+
+GENESIS_PREVIOUS_HASH = "0" * 64  # headers carry raw 32 byte hashes, so genesis points at all zeroes
+MANIFEST_FIELDS = ("user", "v_file", "file_size", "merkle_root", "ref_tx")  # what pruning keeps of a transaction
+SUMMARY_HASH_SIZE = 32  # bytes a pruned block spends on the hash of each transaction it cuts down
+
+
+def transaction_hash(transaction):
+    return sha256(codec.encode_transaction(transaction)).hexdigest()
+
 
 class Block:
-    def __init__(self, index, transactions, previous_hash):
+    def __init__(self, index, transactions, previous_hash, timestamp=None, nonce=0, merkle_root=None, hash=None,
+                 target=POW_LIMIT, tx_hashes=None):
         self.index = index
         self.transactions = transactions
+        # Pruned blocks carry the hash of each transaction cut down to a summary, None for those kept whole
+        self._tx_hashes = tx_hashes
+        self._computed_hashes = None  # hashes served by tx_hashes, refreshed whenever the Merkle root is computed
         self.previous_hash = previous_hash
-        self.nonce = 0
-        self.timestamp = time.time()
-        self.hash = self.compute_hash()
+        self.nonce = nonce
+        self.timestamp = time.time() if timestamp is None else timestamp
+        # The hash must be below the target; dicts carry it as a hex string
+        self.target = int(target, 16) if isinstance(target, str) else target
+        # The header commits to the transactions through their Merkle root, computed once here
+        self.merkle_root = self.compute_merkle_root() if merkle_root is None else merkle_root
+        self.hash = self.compute_hash() if hash is None else hash
+
+    @property
+    def pruned(self):
+        return self._tx_hashes is not None
+
+    def _hash_transactions(self):
+        stored = self._tx_hashes or [None] * len(self.transactions)
+        self._computed_hashes = [tx_hash or transaction_hash(tx) for tx_hash, tx in zip(stored, self.transactions)]
+        return self._computed_hashes
+
+    def tx_hashes(self):
+        if self._computed_hashes is None:
+            self._hash_transactions()
+        return list(self._computed_hashes)
+
+    # Per transaction, its hash if this pruned block only keeps a summary of it, else None
+    def summary_hashes(self):
+        return list(self._tx_hashes) if self._tx_hashes is not None else [None] * len(self.transactions)
+
+    # Hashes the transactions as they are now, so validation notices any changed in place
+    def compute_merkle_root(self):
+        return merkle_root(self._hash_transactions())
+
+    def merkle_proof(self, tx_index):
+        return merkle_proof(self.tx_hashes(), tx_index)
+
+    # Fixed size header without the nonce. Miners hash this once and only feed the nonce per attempt
+    def header_prefix(self):
+        return codec.encode_header_prefix(self.index, self.previous_hash, self.merkle_root, self.timestamp, self.target)
+
+    @staticmethod
+    def encode_nonce(nonce):
+        return codec.encode_nonce(nonce)
 
     def compute_hash(self):
-        block_string = json.dumps({
+        return sha256(self.header_prefix() + self.encode_nonce(self.nonce)).hexdigest()
+
+    def to_bytes(self):
+        return codec.encode_pruned_block(self) if self.pruned else codec.encode_block(self)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[0] == codec.PRUNED_RECORD:
+            return cls(**codec.decode_pruned_block_fields(data))
+        fields, _ = codec.decode_block_fields(data)
+        return cls(**fields)
+
+    # Copy with the transactions cut down to their file manifest fields where that saves
+    # space. Chunk lists, fees, extra fields and free-form transactions are dropped; the
+    # content hash is the Merkle root of the chunk list, so it still pins the file down.
+    # A cut down transaction keeps its 32 byte hash so the block's Merkle root still
+    # holds, so only those that shrink by more than that are cut (files of two chunks
+    # or more). Returns the block itself when nothing is.
+    def to_pruned(self):
+        if self.pruned:
+            return self
+        summaries, hashes = [], []
+        for tx_hash, tx in zip(self.tx_hashes(), self.transactions):
+            summary = {k: tx[k] for k in MANIFEST_FIELDS if k in tx} if isinstance(tx, dict) else {}
+            saved = len(codec.encode_transaction(tx)) - len(codec.encode_summary(summary)[1])
+            if summary != tx and saved > SUMMARY_HASH_SIZE:
+                summaries.append(summary)
+                hashes.append(tx_hash)
+            else:
+                summaries.append(tx)
+                hashes.append(None)
+        if not any(hashes):
+            return self
+        pruned = Block(self.index, summaries, self.previous_hash, self.timestamp, self.nonce, self.merkle_root,
+                       self.hash, self.target, tx_hashes=hashes)
+        # Each transaction also gets a flag byte, so a block with few cuts may not shrink overall
+        return pruned if len(pruned.to_bytes()) < len(self.to_bytes()) else self
+
+    def to_dict(self):
+        return {
             "index": self.index,
             "transactions": self.transactions,
+            "merkle_root": self.merkle_root,
+            "nonce": self.nonce,
+            "hash": self.hash,
             "previous_hash": self.previous_hash,
+            "timestamp": self.timestamp,
+            "target": f"{self.target:064x}"
+        }
+
+    # Everything needed to check linkage and proof of work, without the transactions
+    def header_dict(self):
+        return {
+            "index": self.index,
+            "merkle_root": self.merkle_root,
             "nonce": self.nonce,
-            "timestamp": self.timestamp
-        }, sort_keys=True).encode()
-        return sha256(block_string).hexdigest()
\ No newline at end of file
+            "hash": self.hash,
+            "previous_hash": self.previous_hash,
+            "timestamp": self.timestamp,
+            "target": f"{self.target:064x}",
+            "tx_count": len(self.transactions)
+        }
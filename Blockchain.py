@@ -1,17 +1,24 @@
 #Import libraries
 import random
-from Block import Block
+from Block import Block, GENESIS_PREVIOUS_HASH
+from difficulty import DifficultySchedule, meets_target, target_for_zeros, timestamp_after
+from miner import mine_block
+from validation import check_header, check_body, check_context
 
 #immutable list of blocks
 class Blockchain:
-    # Difficult for proof of work
+    # Difficult for proof of work, in leading hex zeros of the starting target
     difficulty = 3
+    retarget_interval = 10 # blocks between target adjustments
+    block_time = 10.0 # seconds per block the target is adjusted towards
     #intialize our chain
     def __init__(self):
         self.pending = [] # pending list of data that needs to go on chain.
         self.chain = [] # blockchain
-        genesis_block = Block(0, [], "0") #create a new intital block 
-        genesis_block.hash = genesis_block.generate_hash() #generate hash for that block
+        self.checkpoint = None # (height, hash) of the last block check_chain_validity accepted
+        self.schedule = DifficultySchedule(target_for_zeros(Blockchain.difficulty), Blockchain.retarget_interval, Blockchain.block_time)
+        genesis_block = Block(0, [], GENESIS_PREVIOUS_HASH, target=self.schedule.initial_target) #create a new intital block 
+        genesis_block.hash = genesis_block.compute_hash() #generate hash for that block
         self.chain.append(genesis_block) #append it to our chain
 
     
@@ -19,7 +26,7 @@ class Blockchain:
     def add_block(self, block, hashl):
         prev_hash = self.last_block().hash
         #check the validity of the block
-        if (prev_hash == block.prev_hash and self.is_valid(block, hashl)):
+        if (prev_hash == block.previous_hash and self.is_valid(block, hashl)):
             block.hash = hashl
             self.chain.append(block)
             return True
@@ -32,10 +39,10 @@ class Blockchain:
         if(len(self.pending) > 0): #if there is atleast one pending transaction
             last_block = self.last_block() #get last block
             # Creates a new block to be added to the chain
-            new_block = Block(last_block.index + 1,self.pending,last_block.hash)
+            new_block = Block(last_block.index + 1,self.pending,last_block.hash, timestamp=timestamp_after(last_block), target=self.next_target())
 
-            # runs the our proof of work and gets the consensus. There are 2 different types of p_o_w implemented below. Replace the method name to try another one(p_o_w_2(new_block))
-            hashl = self.p_o_w(new_block)
+            # runs the parallel proof of work across all cores. The single threaded p_o_w and p_o_w_2 below are kept for comparison
+            hashl = mine_block(new_block).hash
             #add the block
             self.add_block(new_block, hashl)
             # Empties the pending list
@@ -48,43 +55,58 @@ class Blockchain:
     #generates a proof of work with the stated difficulty if able to mine a block or not, will update the nonce every iteration. With random nonce
     def p_o_w(self, block):
         block.nonce = 0
-        get_hash = block.generate_hash() #generate hash
-        while not get_hash.startswith("0" * Blockchain.difficulty): #check if it matches our difficulty requirement
+        get_hash = block.compute_hash() #generate hash
+        while not meets_target(get_hash, block.target): #check if it is below the block's target
             block.nonce = random.randint(0,99999999) #generate a random nonce
-            get_hash = block.generate_hash() #generate hash
+            get_hash = block.compute_hash() #generate hash
         return get_hash
     #with incremental nonce
     def p_o_w_2(self, block):
         block.nonce = 0
-        get_hash = block.generate_hash()    #generate hash
-        while not get_hash.startswith("0" * Blockchain.difficulty): #check if it matches our difficulty requirement
+        get_hash = block.compute_hash()    #generate hash
+        while not meets_target(get_hash, block.target): #check if it is below the block's target
             block.nonce += 1    #increment our nonce 
-            get_hash = block.generate_hash()
+            get_hash = block.compute_hash()
         return get_hash
 
+    # Target the next block has to meet, retargeted from the recent block times
+    def next_target(self):
+        recent = {block.hash: block for block in self.chain[-Blockchain.retarget_interval:]}
+        return self.schedule.next_target(self.last_block(), recent.get)
+
     # Adds a new transaction to pending
     def add_pending(self, transaction):
         self.pending.append(transaction)
         
-    # Checks if the chain is valid
+    # Checks if the chain is valid. Only blocks after the last validated checkpoint are re-hashed
     def check_chain_validity(this, chain):
-        result = True
-        prev_hash = "0"
-        #for every block in the chain
-        for block in chain:
-            block_hash = block.hash #get the hash of this block and check if its a valid hash
-            if this.is_valid(block, block.hash) and prev_hash == block.prev_hash:
-                block.hash = block_hash #update the hash
-                prev_hash = block_hash #update the previous hash
-            else:
-                result = False
-        return result
+        start = 0
+        if this.checkpoint is not None:
+            height, checkpoint_hash = this.checkpoint
+            # the checkpoint block still hashing the same means it and its ancestors are unchanged
+            if height < len(chain) and chain[height].hash == checkpoint_hash and chain[height].compute_hash() == checkpoint_hash:
+                start = height + 1
+        parent = chain[start - 1] if start else None
+        # blocks a retarget inside the checked range may look back at
+        window = {block.hash: block for block in chain[max(0, start - Blockchain.retarget_interval):]}
+        #for every block after the checkpoint
+        for block in chain[start:]:
+            valid_header = check_header(block) if block.index else block.compute_hash() == block.hash
+            prev_hash = parent.hash if parent else GENESIS_PREVIOUS_HASH
+            if not (valid_header and check_body(block) and prev_hash == block.previous_hash):
+                return False
+            if parent is not None and not check_context(block, parent, this.schedule, window.get):
+                return False
+            parent = block #update the previous block
+        if chain:
+            this.checkpoint = (len(chain) - 1, chain[-1].hash)
+        return True
 
-    #validity helper method; checks if hash has enough difficulty and matches the hash
+    #validity helper method; checks if hash is below the block's target and matches the hash
     def is_valid(cls, block, block_hash):
 
-        if(block_hash.startswith("0" * Blockchain.difficulty)):
-            if(block.generate_hash() == block_hash):
+        if(meets_target(block_hash, block.target)):
+            if(block.compute_hash() == block_hash):
                 return True
             else:
                 return False
@@ -1,6 +1,7 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from sqlalchemy import inspect, text
 
 # Initialize extensions
 db = SQLAlchemy()
@@ -27,5 +28,27 @@ def create_app():
         
         # Create tables
         db.create_all()
+        upgrade_schema()
+
+    # Confirmations arrive from the node's event stream as blocks land
+    if app.config.get('NODE_EVENTS', True):
+        from app.subscriber import ConfirmationSubscriber
+        ConfirmationSubscriber(app, views.ADDR).start()
     
-    return app
\ No newline at end of file
+    return app
+
+
+def upgrade_schema():
+    # create_all() skips existing tables, so add the columns and indexes introduced since
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
\ No newline at end of file
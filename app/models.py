@@ -15,12 +15,27 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+class Blob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), index=True, unique=True, nullable=False)  # Merkle root of the chunk digests
+    path = db.Column(db.String(512), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # File rows sharing this copy
+    files = db.relationship('File', backref='blob', lazy='dynamic')
+
 class File(db.Model):
+    __table_args__ = (
+        db.Index('ix_file_user_filename_tx', 'user_id', 'filename', 'blockchain_tx'),  # downloads by name
+        db.Index('ix_file_user_uploaded', 'user_id', 'uploaded_at', 'id'),  # keyset pages of the file list
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(256), nullable=False)
     filepath = db.Column(db.String(512), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     size = db.Column(db.Integer, nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
-    blockchain_tx = db.Column(db.String(128))  # Stores blockchain transaction reference
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'))  # Stored content, shared by identical uploads
+    blockchain_tx = db.Column(db.String(128), index=True)  # Stores blockchain transaction reference
+    block_index = db.Column(db.Integer)  # Height of the block that confirmed the transaction
     is_mined = db.Column(db.Boolean, default=False)  # Track if file is mined into blockchain
\ No newline at end of file
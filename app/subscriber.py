@@ -0,0 +1,127 @@
+import json
+import logging
+import threading
+import requests
+
+logger = logging.getLogger(__name__)
+
+BATCH_WINDOW = 0.5  # seconds events are collected before one database commit
+MAX_BATCH = 100  # events per commit at most
+RECONNECT_DELAY = 2  # seconds before reconnecting to the node
+RECONCILE_LIMIT = 500  # unconfirmed files checked against the node after (re)connecting
+
+
+# Reads a server-sent events stream, yielding (id, event, data) per event
+def parse_sse(lines):
+    event_id, kind, data = None, "message", []
+    for line in lines:
+        if line == "":
+            if data:
+                yield event_id, kind, "\n".join(data)
+            kind, data = "message", []
+        elif line.startswith(":"):
+            continue
+        else:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "id":
+                event_id = value
+            elif field == "event":
+                kind = value
+            elif field == "data":
+                data.append(value)
+
+
+# Background thread following the node's /events stream. Blocks landing or being
+# rolled back update File.is_mined and block_index in batches, one commit per
+# batch, so confirmations show up within a block interval without polling.
+class ConfirmationSubscriber:
+    def __init__(self, app, node_url):
+        self.app = app
+        self.node_url = node_url
+        self.last_id = None
+        self.session = requests.Session()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="confirmation-subscriber", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._follow()
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Event stream from {self.node_url} interrupted: {str(e)}")
+            except Exception:
+                logger.exception("Applying node events failed")
+            self._stop.wait(RECONNECT_DELAY)
+
+    def _follow(self):
+        headers = {"Accept": "text/event-stream"}
+        if self.last_id is not None:
+            headers["Last-Event-ID"] = self.last_id
+        with self.session.get(f"{self.node_url}/events", headers=headers, stream=True, timeout=(5, None)) as response:
+            response.raise_for_status()
+            # Events older than the node's history, or from before a node restart, are not
+            # replayed; blocks mined while we were not listening are found by asking
+            self.reconcile()
+
+            # The reader thread hands events over so a batch can be flushed on a timer
+            batch, lock, done = [], threading.Lock(), threading.Event()
+
+            def read():
+                try:
+                    # chunk_size=1 hands each line over as it arrives instead of waiting for a full buffer
+                    for event_id, kind, data in parse_sse(response.iter_lines(chunk_size=1, decode_unicode=True)):
+                        with lock:
+                            batch.append((kind, json.loads(data)))
+                            self.last_id = event_id
+                finally:
+                    done.set()
+
+            reader = threading.Thread(target=read, daemon=True)
+            reader.start()
+            while not done.wait(BATCH_WINDOW) or batch:
+                with lock:
+                    pending, batch[:] = batch[:MAX_BATCH], batch[MAX_BATCH:]
+                if pending:
+                    self.apply(pending)
+                if self._stop.is_set():
+                    return
+
+    def apply(self, batch):
+        from app import db
+        from app.views import confirm_files, unconfirm_files
+
+        with self.app.app_context():
+            try:
+                for kind, data in batch:
+                    if kind == "block_connected":
+                        confirm_files(data["tx_hashes"], data["index"])
+                    elif kind == "block_disconnected":
+                        unconfirm_files(data["tx_hashes"], data["index"])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    # Confirms files whose transactions made it into a block while no stream was open
+    def reconcile(self):
+        from app import db
+        from app.models import File
+
+        with self.app.app_context():
+            files = File.query.filter(File.is_mined.is_(False), File.blockchain_tx.isnot(None)) \
+                .order_by(File.id.desc()).limit(RECONCILE_LIMIT).all()
+            for file in files:
+                response = self.session.get(f"{self.node_url}/tx/{file.blockchain_tx}", timeout=5)
+                if response.status_code == 200 and response.json().get("status") == "confirmed":
+                    file.is_mined = True
+                    file.block_index = response.json()["block_index"]
+            db.session.commit()
@@ -1,33 +1,176 @@
 import os
+import tempfile
+from functools import lru_cache
 import requests
 from flask import (
     render_template, redirect, request,
-    send_file, flash, url_for
+    send_file, flash, url_for, session
 )
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 from flask_login import (
     login_required, current_user,
     login_user, logout_user
 )
 from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 from app import db, login_manager
-from app.models import User, File
+from app.models import User, File, Blob
 from app.forms import LoginForm
+from chunk_store import iter_chunks, build_manifest, verify_range
+from light_client import LightClient
+from placement import ShardClient
 
 # Configuration
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx'}
 ADDR = "http://127.0.0.1:8800"
 UPLOAD_FOLDER = 'static/Uploads'
+HEADERS_FILE = 'headers.dat'  # block headers synced by the light client
+FILES_PER_PAGE = 50
+CONFIRM_BATCH = 500  # transaction ids per UPDATE, below SQLite's bound parameter limit
+
+
+# Keep-alive connection to the node, uploads make one request per chunk
+node_session = requests.Session()
+shard_client = ShardClient()
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def push_chunk(digest, data):
+    # The store is content addressed, skip chunks the node already has
+    if node_session.head(f"{ADDR}/chunks/{digest}", timeout=5).status_code == 200:
+        return
+    response = node_session.put(
+        f"{ADDR}/chunks/{digest}",
+        data=data,
+        headers={'Content-Type': 'application/octet-stream'},
+        timeout=10
+    )
+    response.raise_for_status()
+
+
+# Uploads are stored once per content, under the Merkle root of their chunk digests
+def blob_path(content_hash):
+    return os.path.abspath(os.path.join(UPLOAD_FOLDER, content_hash[:2], content_hash))
+
+
+# Rebuilds a copy missing from UPLOAD_FOLDER from the shards the nodes hold when they
+# run with NODE_ERASURE. Returns False when the node has no layout for the content.
+def restore_blob(content_hash, path):
+    response = node_session.get(f"{ADDR}/shards/{content_hash}", timeout=5)
+    if response.status_code == 404:
+        return False
+    response.raise_for_status()
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in shard_client.iter_file(response.json()):
+                out.write(chunk)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+# Commits an upload's File row. Two uploads of the same new content both create a
+# Blob and the second insert fails on the unique content_hash; its File row is then
+# attached to the Blob that won. Both moved identical bytes to the same blob_path.
+def commit_upload(new_file, content_hash):
+    fields = {column: getattr(new_file, column) for column in
+              ('filename', 'filepath', 'user_id', 'size', 'blockchain_tx', 'is_mined')}
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        blob = Blob.query.filter_by(content_hash=content_hash).one()
+        blob.ref_count += 1
+        db.session.add(File(blob=blob, **fields))
+        db.session.commit()
+
+
+# Rolls back a failed upload and removes the copy it wrote, unless the copy is the
+# blob of `content_hash` and a committed Blob row (another upload's) now owns it
+def discard_upload(path, content_hash=None):
+    db.session.rollback()
+    if not path or not os.path.exists(path):
+        return
+    if content_hash and path == blob_path(content_hash) \
+            and Blob.query.filter_by(content_hash=content_hash).first():
+        return
+    os.remove(path)
+
+
+# Hash of the confirmed transaction that stored this content on chain, if any
+def stored_on_chain(content_hash):
+    response = node_session.get(f"{ADDR}/file/{content_hash}", timeout=5)
+    if response.status_code != 200:
+        return None
+    return response.json().get('stored_by')
+
+
+# Content hash and chunk digests a confirmed transaction put on chain, following a
+# ref_tx to the transaction that listed the chunks. Confirmed content never changes,
+# so lookups are cached; failures raise and are retried on the next download.
+@lru_cache(maxsize=1024)
+def chain_manifest(tx_hash):
+    response = node_session.get(f"{ADDR}/tx/{tx_hash}", timeout=5)
+    response.raise_for_status()
+    data = response.json()
+    if data['status'] != 'confirmed':
+        raise ValueError(f"Transaction {tx_hash} is not confirmed")
+    tx = data['transaction']
+    if 'ref_tx' in tx:
+        return chain_manifest(tx['ref_tx'])
+    # A pruned transaction keeps the content hash but no longer lists the chunks
+    return tx['merkle_root'], tuple(tx['chunks']) if 'chunks' in tx else None
+
+
+# Chunk digests of a local copy, or None unless their Merkle root is `content_hash`.
+# Used when the chain no longer lists them, it reads the whole file.
+def local_manifest(path, content_hash):
+    with open(path, 'rb') as f:
+        digests = tuple(digest for digest, _ in iter_chunks(f))
+    manifest = build_manifest(digests, os.path.getsize(path))
+    return digests if manifest['merkle_root'] == content_hash else None
+
+
+# Marks the files confirmed by a mined block, one UPDATE per batch of transaction ids
+def confirm_files(tx_hashes, block_index):
+    confirmed = 0
+    for i in range(0, len(tx_hashes), CONFIRM_BATCH):
+        confirmed += File.query.filter(
+            File.blockchain_tx.in_(tx_hashes[i:i + CONFIRM_BATCH]),
+            File.is_mined.is_(False)
+        ).update({File.is_mined: True, File.block_index: block_index}, synchronize_session=False)
+    return confirmed
+
+
+# Reverts files whose block was rolled back by a reorg to pending
+def unconfirm_files(tx_hashes, block_index):
+    reverted = 0
+    for i in range(0, len(tx_hashes), CONFIRM_BATCH):
+        reverted += File.query.filter(
+            File.blockchain_tx.in_(tx_hashes[i:i + CONFIRM_BATCH]),
+            File.block_index == block_index
+        ).update({File.is_mined: False, File.block_index: None}, synchronize_session=False)
+    return reverted
+
+
 def init_app(app):
     app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    # Checks storage proofs against headers it validated itself instead of the node's word
+    light_client = LightClient(ADDR, path=HEADERS_FILE)
 
     @login_manager.user_loader
     def load_user(user_id):
@@ -71,22 +214,39 @@ def init_app(app):
     @app.route("/")
     @login_required
     def index():
-        user_files = File.query.filter_by(user_id=current_user.id).order_by(File.uploaded_at.desc()).all()
+        # Keyset pagination: a page starts after the (uploaded_at, id) of the last file shown,
+        # so deep pages cost the same as the first one
+        query = File.query.filter_by(user_id=current_user.id)
+        after = request.args.get('after', type=int)
+        if after:
+            last = File.query.filter_by(id=after, user_id=current_user.id).first()
+            if last:
+                query = query.filter(or_(
+                    File.uploaded_at < last.uploaded_at,
+                    and_(File.uploaded_at == last.uploaded_at, File.id < last.id)
+                ))
+        user_files = query.order_by(File.uploaded_at.desc(), File.id.desc()).limit(FILES_PER_PAGE + 1).all()
+        next_after = user_files[FILES_PER_PAGE - 1].id if len(user_files) > FILES_PER_PAGE else None
+        user_files = user_files[:FILES_PER_PAGE]
 
         request_tx = [{
+            "id": f.id,
             "user": current_user.username,
             "v_file": f.filename,
             "file_size": f.size,
             "uploaded_at": f.uploaded_at.strftime('%Y-%m-%d %H:%M'),
             "is_mined": f.is_mined,
-            "blockchain_tx": f.blockchain_tx
+            "blockchain_tx": f.blockchain_tx,
+            "block_index": f.block_index
         } for f in user_files]
 
         return render_template("index.html",
                                title="FileStorage",
                                subtitle="Decentralized File Storage",
                                node_address=ADDR,
-                               request_tx=request_tx)
+                               mining_job=session.get('mining_job'),
+                               request_tx=request_tx,
+                               next_after=next_after)
 
     @app.route("/submit", methods=["POST"])
     @login_required
@@ -114,29 +274,61 @@ def init_app(app):
                 return redirect("/")
 
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-
-            new_file = File(
-                filename=filename,
-                filepath=filepath,
-                user_id=current_user.id,
-                size=file_size,
-                is_mined=False
-            )
-            db.session.add(new_file)
-
-            with open(filepath, 'rb') as f:
-                file_content = f.read()
+            new_blob = None
 
             transaction = {
                 "user": current_user.username,
-                "v_file": filename,
-                "file_data": file_content.hex(),
-                "file_size": file_size
+                "v_file": filename
             }
 
             try:
+                # Single pass over the upload: each chunk is hashed, written to a temporary file
+                # and pushed to the node's chunk store as raw bytes before the next one is read
+                digests = []
+                with tempfile.NamedTemporaryFile(dir=app.config['UPLOAD_FOLDER'], delete=False) as out:
+                    filepath = out.name
+                    for digest, data in iter_chunks(file.stream):
+                        out.write(data)
+                        push_chunk(digest, data)
+                        digests.append(digest)
+                manifest = build_manifest(digests, file_size)
+                content_hash = manifest['merkle_root']
+
+                # Identical content is kept once and shared, only new content is moved into place
+                blob = Blob.query.filter_by(content_hash=content_hash).first()
+                if blob:
+                    os.remove(filepath)
+                else:
+                    new_blob = blob = Blob(content_hash=content_hash, path=blob_path(content_hash), size=file_size, ref_count=0)
+                    os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+                    # A concurrent upload of the same content may have put the same bytes there
+                    os.replace(filepath, blob.path)
+                    db.session.add(blob)
+                # From here on only a copy this upload created is removed on failure
+                filepath = new_blob.path if new_blob else None
+                blob.ref_count += 1
+
+                new_file = File(
+                    filename=filename,
+                    filepath=blob.path,
+                    user_id=current_user.id,
+                    size=file_size,
+                    blob=blob,
+                    is_mined=False
+                )
+                db.session.add(new_file)
+
+                # Content already confirmed on chain is referenced instead of listing its chunks again
+                ref_tx = stored_on_chain(content_hash)
+                if ref_tx:
+                    transaction.update({
+                        "file_size": file_size,
+                        "merkle_root": content_hash,
+                        "ref_tx": ref_tx
+                    })
+                else:
+                    transaction.update(manifest)
+
                 response = requests.post(
                     f"{ADDR}/new_transaction",
                     json=transaction,
@@ -144,33 +336,35 @@ def init_app(app):
                     timeout=10
                 )
 
-                if response.status_code == 201:
-                    db.session.commit()
-                    flash('File uploaded and transaction created! Mine a block to confirm.', 'success')
+                if response.status_code in (200, 201):
+                    # 200: the same transaction is already pending on the node, the file joins it
+                    new_file.blockchain_tx = response.json().get('tx_hash')
+                    commit_upload(new_file, content_hash)
+                    if response.status_code == 201:
+                        flash('File uploaded and transaction created! Mine a block to confirm.', 'success')
+                    else:
+                        flash('File uploaded, its transaction is already pending. Mine a block to confirm.', 'success')
                 else:
-                    db.session.rollback()
-                    os.remove(filepath)
+                    discard_upload(filepath, content_hash)
                     error = response.json().get('error', response.text)
                     flash(f'Blockchain error: {error}', 'danger')
 
             except requests.exceptions.RequestException as e:
-                db.session.rollback()
-                os.remove(filepath)
+                discard_upload(locals().get('filepath'), locals().get('content_hash'))
                 flash(f'Network error: {str(e)}', 'danger')
 
             return redirect("/")
 
         except Exception as e:
-            db.session.rollback()
-            if 'filepath' in locals() and os.path.exists(filepath):
-                os.remove(filepath)
+            discard_upload(locals().get('filepath'), locals().get('content_hash'))
             flash(f'Unexpected error: {str(e)}', 'danger')
             return redirect("/")
 
-    @app.route("/submit/<string:filename>", methods=["GET"])
+    # Files are addressed by id, a user may upload several under the same name
+    @app.route("/submit/<int:file_id>", methods=["GET"])
     @login_required
-    def download_file(filename):
-        file_record = File.query.filter_by(filename=filename, user_id=current_user.id).first()
+    def download_file(file_id):
+        file_record = File.query.filter_by(id=file_id, user_id=current_user.id).first()
         if not file_record:
             flash("File not found", 'danger')
             return redirect(url_for('index'))
@@ -179,50 +373,114 @@ def init_app(app):
             flash("File not yet confirmed in blockchain. Please mine a block first.", 'warning')
             return redirect(url_for('index'))
 
-        if not os.path.exists(file_record.filepath):
-            flash("File not found on server", 'danger')
-            return redirect(url_for('index'))
-
         try:
-            return send_file(file_record.filepath, as_attachment=True)
+            content_hash, digests = chain_manifest(file_record.blockchain_tx)
+            if not os.path.exists(file_record.filepath) and not restore_blob(content_hash, file_record.filepath):
+                flash("File not found on server", 'danger')
+                return redirect(url_for('index'))
+            if digests is None:
+                digests = local_manifest(file_record.filepath, content_hash)
+                if digests is None:
+                    flash("File does not match its blockchain record", 'danger')
+                    return redirect(url_for('index'))
+
+            # The content hash is the ETag, a client holding the file needs nothing else
+            if request.if_none_match.contains(content_hash):
+                start = stop = 0
+            else:
+                size = os.path.getsize(file_record.filepath)
+                byte_range = request.range.range_for_length(size) if request.range else None
+                start, stop = byte_range or (0, size)
+            # Only the chunks overlapping the requested bytes are hashed against the chain
+            if not verify_range(file_record.filepath, digests, start, stop):
+                flash("File does not match its blockchain record", 'danger')
+                return redirect(url_for('index'))
+
+            # send_file hands the open file to the server (sendfile where supported) and
+            # make_conditional answers If-None-Match and Range requests from it
+            # Relative paths are resolved against the working directory, as on upload, not the app root
+            response = send_file(os.path.abspath(file_record.filepath), as_attachment=True,
+                                 attachment_filename=file_record.filename, add_etags=False)
+            response.set_etag(content_hash)
+            return response.make_conditional(request, accept_ranges=True,
+                                             complete_length=os.path.getsize(file_record.filepath))
+        except HTTPException:
+            # 416 for a range past the end of the file
+            raise
+        except requests.exceptions.RequestException as e:
+            flash(f"Could not check the file against the blockchain: {str(e)}", 'danger')
+            return redirect(url_for('index'))
         except Exception as e:
             flash(f"Download failed: {str(e)}", 'danger')
             return redirect(url_for('index'))
 
+    @app.route("/verify/<int:file_id>", methods=["GET"])
+    @login_required
+    def verify_file(file_id):
+        file_record = File.query.filter_by(id=file_id, user_id=current_user.id).first()
+        if not file_record or not file_record.blockchain_tx:
+            flash("File not found", 'danger')
+            return redirect(url_for('index'))
+
+        try:
+            light_client.sync()
+            if file_record.blob:
+                proof = light_client.verify_file(file_record.blockchain_tx, file_record.blob.content_hash)
+            else:
+                proof = light_client.verify_transaction(file_record.blockchain_tx)
+            flash(f"{file_record.filename} is stored in block #{proof['block_index']} "
+                  f"with {proof['confirmations']} confirmations", 'success')
+        except ValueError as e:
+            flash(f"Could not prove {file_record.filename} is on chain: {str(e)}", 'danger')
+        except requests.exceptions.RequestException as e:
+            flash(f"Could not reach the blockchain node: {str(e)}", 'danger')
+        return redirect(url_for('index'))
+
     @app.route("/mine", methods=["GET"])
     @login_required
     def mine_unconfirmed_transactions():
         try:
-            # First get pending transactions
-            pending_resp = requests.get(f"{ADDR}/pending_tx", timeout=5)
-            pending_resp.raise_for_status()
-            pending_tx = pending_resp.json().get('pending', [])
-
-            if not pending_tx:
-                flash("No transactions to mine", 'info')
-                return redirect(url_for('index'))
-
-            # Mine the block
-            mine_resp = requests.get(f"{ADDR}/mine", timeout=10)
+            # Mining runs as a job on the node, we only start it here
+            mine_resp = requests.get(f"{ADDR}/mine", timeout=5)
             mine_resp.raise_for_status()
             mine_data = mine_resp.json()
 
-            if mine_data.get('message') == "New Block Forged":
-                for tx in pending_tx:
-                    file = File.query.filter_by(
-                        filename=tx['v_file'],
-                        user_id=current_user.id
-                    ).first()
-                    if file:
-                        file.is_mined = True
-                        file.blockchain_tx = str(mine_data['index'])
-                db.session.commit()
-                flash(f"Mined Block #{mine_data['index']} with {len(pending_tx)} transactions", 'success')
-            else:
-                flash(mine_data.get('message', 'Mining failed'), 'danger')
+            if 'job_id' not in mine_data:
+                flash(mine_data.get('message', 'No transactions to mine'), 'info')
+                return redirect(url_for('index'))
 
-            return redirect(url_for('index'))
+            session['mining_job'] = mine_data['job_id']
+            return redirect(url_for('mining_status', job_id=mine_data['job_id']))
 
         except requests.exceptions.RequestException as e:
             flash(f"Mining failed: {str(e)}", 'danger')
             return redirect(url_for('index'))
+
+    @app.route("/mine/<string:job_id>", methods=["GET"])
+    @login_required
+    def mining_status(job_id):
+        try:
+            job_resp = requests.get(f"{ADDR}/mine/{job_id}", timeout=5)
+            job_resp.raise_for_status()
+            job = job_resp.json()
+        except requests.exceptions.RequestException as e:
+            flash(f"Could not check mining job: {str(e)}", 'danger')
+            return redirect(url_for('index'))
+
+        if job['status'] in ('queued', 'running'):
+            flash(f"Block is still being mined ({job['hashes']} hashes tried). Check again shortly.", 'info')
+            return redirect(url_for('index'))
+
+        session.pop('mining_job', None)
+        if job['status'] == 'done':
+            mined = job['block']
+            # Confirm exactly the files whose transactions went into the block
+            confirm_files([tx['tx_hash'] for tx in mined['transactions']], mined['index'])
+            db.session.commit()
+            flash(f"Mined Block #{mined['index']} with {len(mined['transactions'])} transactions", 'success')
+        elif job['status'] == 'empty':
+            flash("No transactions to mine", 'info')
+        else:
+            flash(f"Mining failed: {job.get('error') or 'unknown error'}", 'danger')
+
+        return redirect(url_for('index'))
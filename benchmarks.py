@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from Block import Block, GENESIS_PREVIOUS_HASH, transaction_hash
+from difficulty import DifficultySchedule, POW_LIMIT, meets_target, target_for_zeros
+from merkle import merkle_root
+from miner import mine
+from validation import ChainValidator
+
+# Reproducible performance benchmarks for mining, hashing, validation and
+# serialization. Every trial is seeded from --seed, results are summarized as
+# percentiles and written as JSON so runs can be compared across releases:
+#
+#     python benchmarks.py --output baseline.json
+#     python benchmarks.py --compare baseline.json
+
+DEFAULT_SEED = 1234
+DEFAULT_TRIALS = 20
+REGRESSION_THRESHOLD = 0.10  # a median this much worse than the baseline is reported
+PERCENTILES = (50, 90, 99)
+
+
+def random_digest(rng):
+    return rng.getrandbits(256).to_bytes(32, "big").hex()
+
+
+def random_transaction(rng, chunks=4):
+    digests = [random_digest(rng) for _ in range(chunks)]
+    return {
+        "user": f"user{rng.randrange(1000)}",
+        "v_file": f"file{rng.randrange(10 ** 6)}.pdf",
+        "file_size": chunks * 256 * 1024,
+        "chunks": digests,
+        "merkle_root": merkle_root(digests)
+    }
+
+
+def random_block(rng, tx_count, target=POW_LIMIT):
+    return Block(1, [random_transaction(rng) for _ in range(tx_count)], random_digest(rng),
+                 timestamp=1_700_000_000 + rng.random(), target=target)
+
+
+def percentile(sorted_samples, p):
+    # Nearest-rank percentile
+    rank = max(1, -(-p * len(sorted_samples) // 100))
+    return sorted_samples[rank - 1]
+
+
+def summarize(samples, unit, higher_is_better=True, **extra):
+    ordered = sorted(samples)
+    summary = {
+        "unit": unit,
+        "higher_is_better": higher_is_better,
+        "trials": len(samples),
+        "mean": sum(samples) / len(samples),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "samples": samples
+    }
+    for p in PERCENTILES:
+        summary[f"p{p}"] = percentile(ordered, p)
+    summary.update(extra)
+    return summary
+
+
+# Calls `fn` `number` times and returns calls per second
+def rate(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return number / (time.perf_counter() - start)
+
+
+# ------------------------ mining ------------------------
+
+# Same search as Blockchain.p_o_w (random nonce) and p_o_w_2 (next nonce), counting attempts
+def solve_random(block, rng):
+    attempts = 1
+    block.nonce = rng.randrange(2 ** 63)
+    while not meets_target(block.compute_hash(), block.target):
+        block.nonce = rng.randrange(2 ** 63)
+        attempts += 1
+    return attempts
+
+
+def solve_sequential(block, rng):
+    attempts = 1
+    block.nonce = 0
+    while not meets_target(block.compute_hash(), block.target):
+        block.nonce += 1
+        attempts += 1
+    return attempts
+
+
+def bench_nonce_strategies(args):
+    results = {}
+    target = target_for_zeros(args.pow_zeros)
+    for name, solve in (("random", solve_random), ("sequential", solve_sequential)):
+        rates, times = [], []
+        for trial in range(args.trials):
+            rng = random.Random(args.seed + trial)
+            block = random_block(rng, 10, target)
+            start = time.perf_counter()
+            attempts = solve(block, rng)
+            elapsed = time.perf_counter() - start
+            rates.append(attempts / elapsed)
+            times.append(elapsed)
+        results[f"mining.{name}_nonce.hash_rate"] = summarize(rates, "hashes/s", difficulty_zeros=args.pow_zeros)
+        results[f"mining.{name}_nonce.time_to_block"] = summarize(times, "s", higher_is_better=False,
+                                                                  difficulty_zeros=args.pow_zeros)
+    return results
+
+
+def bench_parallel_mining(args):
+    results = {}
+    target = target_for_zeros(args.miner_zeros)
+    for workers in sorted({1, os.cpu_count() or 1}):
+        rates = []
+        for trial in range(args.trials):
+            rng = random.Random(args.seed + trial)
+            block = random_block(rng, 10, target)
+            result = mine(block.header_prefix(), target, workers=workers, seed=args.seed + trial)
+            rates.append(result.hash_rate)
+        results[f"mining.miner.workers_{workers}.hash_rate"] = summarize(rates, "hashes/s",
+                                                                         difficulty_zeros=args.miner_zeros)
+    return results
+
+
+# ------------------------ hashing ------------------------
+
+def bench_hashing(args):
+    results = {}
+    for tx_count in args.payload_sizes:
+        header_rates, merkle_rates = [], []
+        for trial in range(args.trials):
+            block = random_block(random.Random(args.seed + trial), tx_count)
+            header_rates.append(rate(block.compute_hash, 2000))
+            merkle_rates.append(rate(block.compute_merkle_root, max(1, 2000 // max(tx_count, 1))))
+        results[f"hashing.compute_hash.txs_{tx_count}"] = summarize(header_rates, "hashes/s", tx_count=tx_count)
+        results[f"hashing.merkle_root.txs_{tx_count}"] = summarize(merkle_rates, "roots/s", tx_count=tx_count)
+    return results
+
+
+# ------------------------ validation ------------------------
+
+# A valid chain of `length` blocks at the easiest target, mined sequentially
+def build_chain(rng, length, tx_count):
+    schedule = DifficultySchedule(POW_LIMIT, 10, 10.0)
+    genesis = Block(0, [], GENESIS_PREVIOUS_HASH, timestamp=0.0, target=schedule.initial_target)
+    chain = [genesis]
+    by_hash = {genesis.hash: genesis}
+    timestamp = 1_700_000_000.0
+    for index in range(1, length + 1):
+        parent = chain[-1]
+        timestamp += rng.uniform(5, 15)
+        block = Block(index, [random_transaction(rng) for _ in range(tx_count)], parent.hash,
+                      timestamp=timestamp, target=schedule.next_target(parent, by_hash.get))
+        solve_sequential(block, rng)
+        block.hash = block.compute_hash()
+        chain.append(block)
+        by_hash[block.hash] = block
+    return schedule, chain
+
+
+def bench_validation(args):
+    schedule, chain = build_chain(random.Random(args.seed), args.chain_length, 10)
+    rates = []
+    for trial in range(args.trials):
+        validator = ChainValidator(schedule, workers=1)
+        start = time.perf_counter()
+        if validator.validate(chain[1:], chain[0]) is None:
+            raise RuntimeError("benchmark chain failed validation")
+        rates.append(args.chain_length / (time.perf_counter() - start))
+    return {"validation.chain.blocks": summarize(rates, "blocks/s", chain_length=args.chain_length, tx_per_block=10)}
+
+
+# ------------------------ serialization ------------------------
+
+def bench_serialization(args):
+    block = random_block(random.Random(args.seed), args.serialization_txs)
+    binary = block.to_bytes()
+    as_json = json.dumps(block.to_dict(), sort_keys=True).encode()
+    cases = {
+        "binary_encode": block.to_bytes,
+        "binary_decode": lambda: Block.from_bytes(binary),
+        "json_encode": lambda: json.dumps(block.to_dict(), sort_keys=True).encode(),
+        "json_decode": lambda: Block(**json.loads(as_json)),
+        "transaction_hash": lambda: [transaction_hash(tx) for tx in block.transactions]
+    }
+    results = {}
+    for name, fn in cases.items():
+        rates = [rate(fn, 20) for _ in range(args.trials)]
+        results[f"serialization.{name}"] = summarize(rates, "blocks/s", tx_count=args.serialization_txs,
+                                                     binary_bytes=len(binary), json_bytes=len(as_json))
+    return results
+
+
+BENCHMARKS = {
+    "nonce": bench_nonce_strategies,
+    "miner": bench_parallel_mining,
+    "hashing": bench_hashing,
+    "validation": bench_validation,
+    "serialization": bench_serialization
+}
+
+
+# ------------------------ reporting ------------------------
+
+def environment(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "trials": args.trials,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    }
+
+
+def print_table(results):
+    print(f"{'benchmark':<44} {'p50':>14} {'p90':>14} {'p99':>14}  unit")
+    for name, r in results.items():
+        print(f"{name:<44} {r['p50']:>14.6g} {r['p90']:>14.6g} {r['p99']:>14.6g}  {r['unit']}")
+
+
+# Benchmarks whose median moved the wrong way by more than `threshold`
+def regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    found = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base or not base["p50"]:
+            continue
+        change = (r["p50"] - base["p50"]) / base["p50"]
+        if (change < -threshold) if r["higher_is_better"] else (change > threshold):
+            found.append((name, base["p50"], r["p50"], change))
+    return found
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Proof of work, hashing, validation and serialization benchmarks")
+    parser.add_argument("--trials", type=int, default=DEFAULT_TRIALS)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run only these groups")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--quick", action="store_true", help="smaller workloads for a fast smoke run")
+    parser.add_argument("--pow-zeros", type=int, default=4, help="difficulty of the nonce strategy runs")
+    parser.add_argument("--miner-zeros", type=int, default=5, help="difficulty of the multi-core miner runs")
+    parser.add_argument("--chain-length", type=int, default=200)
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[0, 10, 100, 1000])
+    parser.add_argument("--serialization-txs", type=int, default=100)
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.trials = min(args.trials, 5)
+        args.pow_zeros = min(args.pow_zeros, 3)
+        args.miner_zeros = min(args.miner_zeros, 4)
+        args.chain_length = min(args.chain_length, 50)
+        args.payload_sizes = [n for n in args.payload_sizes if n <= 100]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"running {name} ...", file=sys.stderr)
+        results.update(BENCHMARKS[name](args))
+
+    print_table(results)
+    report = {"environment": environment(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        found = regressions(results, baseline)
+        for name, before, after, change in found:
+            print(f"REGRESSION {name}: p50 {before:.6g} -> {after:.6g} ({change:+.1%})")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from Block import Block
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct(">II")  # payload length, crc32 of payload
+INDEX_ENTRY = struct.Struct(">Q")  # offset of the record in the log
+CACHE_SIZE = 256  # decoded blocks kept in memory
+
+
+def encode_block(block):
+    return block.to_bytes()
+
+
+def decode_block(payload):
+    return Block.from_bytes(payload)
+
+
+# Append-only, fsynced block log. `<path>.log` holds length prefixed records and
+# `<path>.idx` one fixed width offset per height. Only the index is mapped at
+# start-up, blocks are decoded on first access.
+class BlockLog:
+    def __init__(self, path, encode=encode_block, decode=decode_block, cache_size=CACHE_SIZE):
+        self.log_path = path + ".log"
+        self.index_path = path + ".idx"
+        self.encode = encode
+        self.decode = decode
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()  # the cache, tail offsets and index map are shared by request threads
+
+        directory = os.path.dirname(self.log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._log = open(self.log_path, "a+b")
+        self._index = open(self.index_path, "a+b")
+        self._map = None
+        self._mapped = 0
+        self._tail = []  # offsets appended after the index was mapped
+        self._recover()
+        self._remap()
+
+    # ------------------------ recovery ------------------------
+
+    def _read_record(self, offset, log_size):
+        if offset + RECORD_HEADER.size > log_size:
+            return None
+        length, crc = RECORD_HEADER.unpack(os.pread(self._log.fileno(), RECORD_HEADER.size, offset))
+        end = offset + RECORD_HEADER.size + length
+        if end > log_size:
+            return None
+        payload = os.pread(self._log.fileno(), length, offset + RECORD_HEADER.size)
+        if zlib.crc32(payload) != crc:
+            return None
+        return payload, end
+
+    def _recover(self):
+        log_size = os.path.getsize(self.log_path)
+        index_size = os.path.getsize(self.index_path)
+        count = index_size // INDEX_ENTRY.size
+
+        # Drop index entries that point at records that did not make it to disk
+        end = 0
+        while count:
+            offset, = INDEX_ENTRY.unpack(os.pread(self._index.fileno(), INDEX_ENTRY.size, (count - 1) * INDEX_ENTRY.size))
+            record = self._read_record(offset, log_size)
+            if record:
+                end = record[1]
+                break
+            count -= 1
+
+        # Index whatever complete records follow, the index may lag the log after a crash
+        offsets = []
+        while True:
+            record = self._read_record(end, log_size)
+            if not record:
+                break
+            offsets.append(end)
+            end = record[1]
+
+        if end < log_size:
+            logger.warning(f"Truncating torn tail of {self.log_path} at byte {end} (was {log_size})")
+            self._log.truncate(end)
+            self._sync(self._log)
+
+        if count * INDEX_ENTRY.size != index_size or offsets:
+            self._index.truncate(count * INDEX_ENTRY.size)
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(b"".join(INDEX_ENTRY.pack(o) for o in offsets))
+            self._sync(self._index)
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        size = os.path.getsize(self.index_path)
+        if size:
+            self._map = mmap.mmap(self._index.fileno(), size, access=mmap.ACCESS_READ)
+        self._mapped = size // INDEX_ENTRY.size
+        self._tail = []
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    # ------------------------ access ------------------------
+
+    def __len__(self):
+        return self._mapped + len(self._tail)
+
+    def _offset(self, height):
+        if height < self._mapped:
+            return INDEX_ENTRY.unpack_from(self._map, height * INDEX_ENTRY.size)[0]
+        return self._tail[height - self._mapped]
+
+    def _payload(self, height):
+        offset = self._offset(height)
+        length, crc = RECORD_HEADER.unpack(os.pread(self._log.fileno(), RECORD_HEADER.size, offset))
+        payload = os.pread(self._log.fileno(), length, offset + RECORD_HEADER.size)
+        if zlib.crc32(payload) != crc:
+            raise IOError(f"Corrupt block record at height {height}")
+        return payload
+
+    def _load(self, height):
+        with self._lock:
+            block = self._cache.get(height)
+            if block is not None:
+                self._cache.move_to_end(height)
+                return block
+
+            block = self.decode(self._payload(height))
+            self._cache[height] = block
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return block
+
+    def __getitem__(self, key):
+        with self._lock:
+            if isinstance(key, slice):
+                return [self._load(h) for h in range(*key.indices(len(self)))]
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError("block height out of range")
+            return self._load(key)
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self._load(height)
+
+    # First `size` bytes of the encoded block at `height`, in one read and without the
+    # rest of the record. The checksum covers the whole payload, so it is not checked.
+    def head(self, height, size):
+        with self._lock:
+            if not 0 <= height < len(self):
+                raise IndexError("block height out of range")
+            data = os.pread(self._log.fileno(), RECORD_HEADER.size + size, self._offset(height))
+        length, _ = RECORD_HEADER.unpack_from(data)
+        return data[RECORD_HEADER.size:RECORD_HEADER.size + min(length, size)]
+
+    # Encoded blocks in height order from `start` up to `stop`, bypassing the decoder and the cache
+    def payloads(self, start=0, stop=None):
+        for height in range(start, len(self) if stop is None else min(stop, len(self))):
+            with self._lock:
+                payload = self._payload(height)
+            yield payload
+
+    # ------------------------ writes ------------------------
+
+    # Returns the encoded size of the block in bytes
+    def append(self, block):
+        return self.append_payload(self.encode(block), block)
+
+    # Appends a block already encoded, `block` is only kept in the cache when given
+    def append_payload(self, payload, block=None):
+        with self._lock:
+            self._log.seek(0, os.SEEK_END)
+            offset = self._log.tell()
+            self._log.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._sync(self._log)
+
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(INDEX_ENTRY.pack(offset))
+            self._sync(self._index)
+
+            self._tail.append(offset)
+            if block is not None:
+                self._cache[len(self) - 1] = block
+        return len(payload)
+
+    # Removes every block at `height` and above
+    def truncate(self, height):
+        with self._lock:
+            if height >= len(self):
+                return
+            offset = self._offset(height)
+            self._log.truncate(offset)
+            self._sync(self._log)
+            self._index.truncate(height * INDEX_ENTRY.size)
+            self._sync(self._index)
+
+            for h in [h for h in self._cache if h >= height]:
+                del self._cache[h]
+            self._remap()
+
+    # Rewrites the log with the blocks at heights start .. stop - 1 replaced by
+    # transform(block); every other record is copied as is. The new log is written
+    # beside the old one and renamed over it. The index is emptied first, so after a
+    # crash it is rebuilt on start-up from whichever log survived.
+    def rewrite(self, start, stop, transform):
+        with self._lock:
+            log_size = os.path.getsize(self.log_path)
+            tmp_path = self.log_path + ".tmp"
+            offsets = []
+            with open(tmp_path, "wb") as out:
+                for height in range(len(self)):
+                    if start <= height < stop:
+                        payload = self.encode(transform(self._load(height)))
+                    else:
+                        payload, _ = self._read_record(self._offset(height), log_size)
+                    offsets.append(out.tell())
+                    out.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+                self._sync(out)
+
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._index.truncate(0)
+            self._sync(self._index)
+            os.replace(tmp_path, self.log_path)
+            self._log.close()
+            self._log = open(self.log_path, "a+b")
+            self._index.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+            self._sync(self._index)
+
+            for height in [h for h in self._cache if start <= h < stop]:
+                del self._cache[height]
+            self._remap()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._log.close()
+        self._index.close()
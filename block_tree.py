@@ -0,0 +1,127 @@
+MAX_SIDE_DEPTH = 100  # side branch blocks older than this many blocks below the tip are dropped
+MAX_SIDE_BLOCKS = 1000  # side blocks no heavier than the tip kept at most, the lightest branch tips go first
+
+
+class TreeNode:
+    __slots__ = ("hash", "parent", "height", "work")
+
+    def __init__(self, hash, parent, height, work):
+        self.hash = hash
+        self.parent = parent
+        self.height = height
+        self.work = work  # cumulative work from genesis up to and including this block
+
+
+# Every known block keyed by hash, main chain and competing branches alike. Nodes
+# only hold linkage and cumulative work; bodies of blocks off the main chain are
+# kept in `side_blocks` so the node can switch to their branch without refetching.
+class BlockTree:
+    def __init__(self, work_of, max_side_depth=MAX_SIDE_DEPTH, max_side_blocks=MAX_SIDE_BLOCKS):
+        self.work_of = work_of
+        self.max_side_depth = max_side_depth
+        self.max_side_blocks = max_side_blocks
+        self.nodes = {}
+        self.side_blocks = {}
+        self.tip = None
+
+    def __contains__(self, block_hash):
+        return block_hash in self.nodes
+
+    def get(self, block_hash):
+        return self.nodes.get(block_hash)
+
+    # Adds a block whose parent is known (or a genesis block) and returns its node
+    def add(self, block):
+        node = self.nodes.get(block.hash)
+        if node is not None:
+            return node
+
+        parent = self.nodes.get(block.previous_hash)
+        if parent is None and block.index != 0:
+            raise KeyError(f"Unknown parent {block.previous_hash}")
+
+        work = (parent.work if parent else 0) + self.work_of(block)
+        node = TreeNode(block.hash, block.previous_hash if parent else None, block.index, work)
+        self.nodes[block.hash] = node
+        return node
+
+    def add_side_block(self, block):
+        node = self.add(block)
+        if block.hash != self.tip:
+            self.side_blocks[block.hash] = block
+        return node
+
+    # (hash, parent, height, work) of the given known blocks, add_entries puts them back
+    def entries(self, hashes):
+        return [(node.hash, node.parent, node.height, node.work) for node in map(self.nodes.get, hashes) if node]
+
+    def add_entries(self, entries):
+        for entry in entries:
+            self.nodes[entry[0]] = TreeNode(*entry)
+
+    def heavier_than_tip(self, block_hash):
+        return self.tip is None or self.nodes[block_hash].work > self.nodes[self.tip].work
+
+    # Last block shared by the branches ending at `a` and `b`
+    def common_ancestor(self, a, b):
+        a, b = self.nodes[a], self.nodes[b]
+        while a.height > b.height:
+            a = self.nodes[a.parent]
+        while b.height > a.height:
+            b = self.nodes[b.parent]
+        while a.hash != b.hash:
+            # Nodes below the pruned blocks are forgotten, a fork down there is no ancestor either
+            if a.parent not in self.nodes or b.parent not in self.nodes:
+                return None
+            a, b = self.nodes[a.parent], self.nodes[b.parent]
+        return a
+
+    # Hashes from just above `ancestor` up to `tip`, in chain order
+    def path(self, ancestor, tip):
+        hashes = []
+        node = self.nodes[tip]
+        while node.hash != ancestor:
+            hashes.append(node.hash)
+            node = self.nodes[node.parent]
+        hashes.reverse()
+        return hashes
+
+    # Forgets side branch blocks that are too deep below the tip to matter, then the
+    # lightest branch tips while more than max_side_blocks are kept. Blocks at the
+    # starting target cost next to nothing to make, so the count is capped as well.
+    # Branches heavier than the tip are kept, the node is about to switch to them.
+    def prune(self):
+        if self.tip is None:
+            return
+        min_height = self.nodes[self.tip].height - self.max_side_depth
+        self.discard(h for h, b in self.side_blocks.items() if b.index < min_height)
+
+        tip_work = self.nodes[self.tip].work
+        while len(self.side_blocks) > self.max_side_blocks:
+            parents = {block.previous_hash for block in self.side_blocks.values()}
+            tips = sorted((self.nodes[h].work, h) for h in self.side_blocks
+                          if h not in parents and self.nodes[h].work <= tip_work)
+            if not tips:
+                break
+            self.discard(h for _, h in tips[:len(self.side_blocks) - self.max_side_blocks])
+
+    # Forgets the nodes below `height` and the side blocks built on them, for when the
+    # node no longer reorganizes below it. Memory then follows the unpruned chain.
+    def forget_below(self, height):
+        self.discard([h for h, block in self.side_blocks.items() if block.index <= height])
+        for block_hash in [h for h, node in self.nodes.items() if node.height < height]:
+            del self.nodes[block_hash]
+
+    # Forgets the side blocks `hashes` and, since they cannot be reached any more, their descendants
+    def discard(self, hashes):
+        stale = set(hashes) & self.side_blocks.keys()
+        changed = bool(stale)
+        while changed:
+            changed = False
+            for block_hash, block in self.side_blocks.items():
+                if block_hash not in stale and block.previous_hash in stale:
+                    stale.add(block_hash)
+                    changed = True
+        for block_hash in stale:
+            del self.side_blocks[block_hash]
+            del self.nodes[block_hash]
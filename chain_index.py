@@ -0,0 +1,94 @@
+import threading
+from codec import transaction_keys
+
+
+# Secondary indexes over the main chain, updated as blocks are connected and
+# rolled back in reverse order when they are disconnected. The chunk index is only
+# kept with `track_chunks`, it is as large as all manifests together. It is built
+# as blocks are connected; rebuilt from a block log holding pruned manifests it
+# misses their chunks and `chunks_complete` is cleared.
+class ChainIndex:
+    def __init__(self, track_chunks=False):
+        self.block_heights = {}  # block hash -> height
+        self.tx_locations = {}  # tx hash -> (height, position in block)
+        self.user_txs = {}  # user -> [tx hash] in chain order
+        self.file_txs = {}  # file content hash (manifest Merkle root) -> [tx hash]
+        self.chunk_files = {} if track_chunks else None  # chunk digest -> [content hash] per confirmed manifest listing it
+        self.chunks_complete = True
+        self._lock = threading.RLock()
+
+    def connect_block(self, block):
+        self.connect_entries(block.index, block.hash, [(tx_hash,) + transaction_keys(tx)
+                                                       for tx_hash, tx in zip(block.tx_hashes(), block.transactions)])
+
+    # Connects a block given as (tx hash, user, content hash, chunks) per transaction,
+    # which codec.scan_block reads from the block log without decoding transactions.
+    # Chunks are None for a pruned manifest that no longer lists them.
+    def connect_entries(self, height, block_hash, entries):
+        with self._lock:
+            self.block_heights[block_hash] = height
+            for position, (tx_hash, user, content_hash, chunks) in enumerate(entries):
+                self.tx_locations[tx_hash] = (height, position)
+                self.user_txs.setdefault(user, []).append(tx_hash)
+                if content_hash:
+                    self.file_txs.setdefault(content_hash, []).append(tx_hash)
+                if self.chunk_files is None:
+                    continue
+                if chunks is None:
+                    self.chunks_complete = False
+                for digest in chunks or ():
+                    self.chunk_files.setdefault(digest, []).append(content_hash)
+
+    def disconnect_block(self, block):
+        with self._lock:
+            self.block_heights.pop(block.hash, None)
+            for tx_hash, tx in reversed(list(zip(block.tx_hashes(), block.transactions))):
+                user, content_hash, chunks = transaction_keys(tx)
+                self.tx_locations.pop(tx_hash, None)
+                self._pop(self.user_txs, user, tx_hash)
+                if content_hash:
+                    self._pop(self.file_txs, content_hash, tx_hash)
+                for digest in reversed(chunks) if self.chunk_files is not None else ():
+                    self._pop(self.chunk_files, digest, content_hash)
+
+    @staticmethod
+    def _pop(mapping, key, value):
+        values = mapping.get(key)
+        if not values:
+            return
+        if values[-1] == value:
+            values.pop()
+        elif value in values:
+            values.remove(value)
+        if not values:
+            del mapping[key]
+
+    # The index as plain containers, what Blockchain.save_state writes next to the block
+    # log, and back. The containers are shared, not copied.
+    def state(self):
+        with self._lock:
+            return (self.block_heights, self.tx_locations, self.user_txs, self.file_txs,
+                    self.chunk_files, self.chunks_complete)
+
+    def load_state(self, state):
+        with self._lock:
+            (self.block_heights, self.tx_locations, self.user_txs, self.file_txs,
+             self.chunk_files, self.chunks_complete) = state
+
+    def height_of(self, block_hash):
+        return self.block_heights.get(block_hash)
+
+    def locate(self, tx_hash):
+        return self.tx_locations.get(tx_hash)
+
+    def transactions_of(self, user):
+        with self._lock:
+            return list(self.user_txs.get(user, []))
+
+    def transactions_for_file(self, content_hash):
+        with self._lock:
+            return list(self.file_txs.get(content_hash, []))
+
+    def files_with_chunk(self, digest):
+        with self._lock:
+            return list((self.chunk_files or {}).get(digest, []))
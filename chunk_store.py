@@ -0,0 +1,123 @@
+import mmap
+import os
+import re
+import tempfile
+from hashlib import sha256
+from merkle import merkle_root
+
+CHUNK_SIZE = 256 * 1024  # fixed chunk size used to split uploads
+
+_DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def is_digest(value):
+    return isinstance(value, str) and _DIGEST_RE.fullmatch(value) is not None
+
+
+# Splits a binary stream into fixed size chunks, yielding (digest, data) pairs
+def iter_chunks(stream, chunk_size=CHUNK_SIZE):
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        yield sha256(data).hexdigest(), data
+
+
+# Manifest that goes into a transaction in place of the file bytes
+def build_manifest(digests, file_size):
+    digests = list(digests)
+    return {
+        "chunks": digests,
+        "merkle_root": merkle_root(digests),
+        "file_size": file_size
+    }
+
+
+# Checks the chunks of the file at `path` that overlap bytes [start, stop) against
+# `digests`, the chunk hashes recorded on chain. The file is memory mapped so only
+# the pages of those chunks are read and nothing is copied into Python objects.
+def verify_range(path, digests, start, stop, chunk_size=CHUNK_SIZE):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if -(-size // chunk_size) != len(digests):
+            return False
+        if size == 0 or start >= stop:
+            return True
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for i in range(start // chunk_size, (min(stop, size) - 1) // chunk_size + 1):
+                    if sha256(view[i * chunk_size:(i + 1) * chunk_size]).hexdigest() != digests[i]:
+                        return False
+            finally:
+                view.release()
+    return True
+
+
+# Content addressed store keeping one file per chunk, named by its sha256 digest
+class ChunkStore:
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        if not is_digest(digest):
+            raise ValueError(f"Invalid chunk digest: {digest!r}")
+        # Two level fan-out keeps directories small
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    def put(self, data, digest=None):
+        actual = sha256(data).hexdigest()
+        if digest is not None and digest != actual:
+            raise ValueError(f"Chunk digest mismatch: expected {digest}, got {actual}")
+
+        path = self.path(actual)
+        if os.path.exists(path):
+            return actual
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial chunk
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return actual
+
+    def get(self, digest):
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def put_stream(self, stream):
+        digests = []
+        file_size = 0
+        for digest, data in iter_chunks(stream, self.chunk_size):
+            self.put(data, digest)
+            digests.append(digest)
+            file_size += len(data)
+        return build_manifest(digests, file_size)
+
+    def iter_file(self, manifest):
+        for digest in manifest["chunks"]:
+            yield self.get(digest)
+
+    def missing(self, digests):
+        return [d for d in digests if not self.has(d)]
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,140 @@
+import argparse
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from hashlib import sha256
+import requests
+from chunk_store import iter_chunks, build_manifest
+from placement import ShardClient
+
+# Starts a cluster of local nodes with erasure coded storage (NODE_ERASURE), uploads
+# a random file to the first one, stops some nodes and reads the file back from the
+# shards that are left:
+#
+#     python cluster_demo.py --nodes 6 --code 4+2 --stop 2
+
+DEFAULT_BASE_PORT = 8900
+STARTUP_TIMEOUT = 30  # seconds for a node to answer
+
+
+def start_nodes(count, base_port, code, root):
+    repo = os.path.dirname(os.path.abspath(__file__))
+    processes, urls = [], []
+    for i in range(count):
+        port = base_port + i
+        url = f"http://127.0.0.1:{port}"
+        data_dir = os.path.join(root, f"node{i}")
+        os.makedirs(data_dir)
+        env = dict(os.environ, NODE_PORT=str(port), NODE_URL=url, NODE_DATA_DIR=data_dir, NODE_ERASURE=code)
+        with open(os.path.join(data_dir, "node.log"), "w") as log:
+            processes.append(subprocess.Popen([sys.executable, "peer.py"], cwd=repo, env=env,
+                                              stdout=log, stderr=subprocess.STDOUT))
+        urls.append(url)
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    for url in urls:
+        while True:
+            try:
+                requests.get(f"{url}/peers", timeout=1)
+                break
+            except requests.exceptions.RequestException:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Node {url} did not start, see its node.log in {root}")
+                time.sleep(0.1)
+    return processes, urls
+
+
+def connect(urls):
+    for url in urls:
+        for peer in urls:
+            if peer != url:
+                requests.post(f"{url}/register_peer", json={"peer": peer}, timeout=5).raise_for_status()
+
+
+def upload(url, data, name):
+    digests = []
+    for digest, chunk in iter_chunks(io.BytesIO(data)):
+        requests.put(f"{url}/chunks/{digest}", data=chunk, timeout=10).raise_for_status()
+        digests.append(digest)
+    manifest = build_manifest(digests, len(data))
+    response = requests.post(f"{url}/new_transaction", json=dict(user="demo", v_file=name, **manifest), timeout=60)
+    response.raise_for_status()
+    return manifest["merkle_root"]
+
+
+def stored_bytes(data_dir):
+    total = 0
+    for directory, _, files in os.walk(os.path.join(data_dir, "chunks")):
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+    return total
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Erasure coded storage on a cluster of local nodes")
+    parser.add_argument("--nodes", type=int, default=6)
+    parser.add_argument("--code", default="4+2", help="data and parity shards per stripe, k+m")
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024, help="bytes in the uploaded file")
+    parser.add_argument("--stop", type=int, default=2, help="nodes stopped before reading the file back")
+    parser.add_argument("--base-port", type=int, default=DEFAULT_BASE_PORT)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--keep", action="store_true", help="keep the node data directories")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    data = rng.getrandbits(8 * args.size).to_bytes(args.size, "big")
+    root = tempfile.mkdtemp(prefix="filestore-cluster-")
+    processes, urls = [], []
+    try:
+        processes, urls = start_nodes(args.nodes, args.base_port, args.code, root)
+        connect(urls)
+        content_hash = upload(urls[0], data, "demo.bin")
+        print(f"Uploaded {args.size} bytes to {urls[0]} as {content_hash} ({args.code})")
+
+        total = 0
+        for i, url in enumerate(urls):
+            used = stored_bytes(os.path.join(root, f"node{i}"))
+            total += used
+            print(f"  {url}  {used:>10} bytes of chunks")
+        print(f"Stored {total} bytes, {total / args.size:.2f}x the file; "
+              f"full copies on every node would take {args.nodes}.00x")
+
+        stopped = sorted(rng.sample(range(args.nodes), args.stop))
+        for i in stopped:
+            processes[i].terminate()
+            processes[i].wait()
+        print(f"Stopped {', '.join(urls[i] for i in stopped)}")
+
+        reader = next(url for i, url in enumerate(urls) if i not in stopped)
+        layout = requests.get(f"{reader}/shards/{content_hash}", timeout=5).json()
+        start = time.perf_counter()
+        try:
+            restored = b"".join(ShardClient(timeout=2).iter_file(layout))
+        except ValueError as e:
+            print(f"Could not read the file back: {str(e)}")
+            return 1
+        elapsed = time.perf_counter() - start
+        match = sha256(restored).digest() == sha256(data).digest()
+        print(f"Read back {len(restored)} bytes in {elapsed:.2f}s, "
+              f"{'identical to' if match else 'DIFFERENT from'} the upload")
+        return 0 if match else 1
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if args.keep:
+            print(f"Node data kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+import json
+import struct
+from hashlib import sha256
+
+# Compact binary encoding of block headers, transactions and blocks. It is what
+# gets hashed, written to the block log and sent between nodes; JSON is still
+# served for debugging when a client does not ask for the binary form.
+
+FORMAT_VERSION = 2
+PRUNED_RECORD = 0xFF  # first byte of a pruned block, full blocks start with FORMAT_VERSION
+BINARY_MIMETYPE = "application/x-filestore-block"
+
+HEADER_PREFIX = struct.Struct(">BQ32s32sd32s")  # version, index, previous hash, merkle root, timestamp, target
+NONCE = struct.Struct(">Q")
+HEADER_SIZE = HEADER_PREFIX.size + NONCE.size
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+HEADER_RECORD_SIZE = HEADER_SIZE + U32.size
+U64 = struct.Struct(">Q")
+
+TX_STRUCTURED = 0  # file transaction with fixed fields
+TX_JSON = 1  # anything else, kept as canonical JSON
+TX_REF = 2  # file transaction pointing at content an earlier transaction stored
+
+_TX_FIELDS = ("user", "v_file", "file_size", "chunks", "merkle_root")
+_REF_FIELDS = ("user", "v_file", "file_size", "merkle_root", "ref_tx")
+_TX_KEYS = frozenset(_TX_FIELDS)
+_REF_KEYS = frozenset(_REF_FIELDS)
+_KIND_AND_LENGTH = struct.Struct(">BH")  # encoding and length of the user field
+_SIZE_AND_ROOT = struct.Struct(">Q32s")  # file size and raw Merkle root
+
+
+def _digest_bytes(value):
+    return bytes.fromhex(value)
+
+
+def encode_header_prefix(index, previous_hash, merkle_root, timestamp, target):
+    return HEADER_PREFIX.pack(
+        FORMAT_VERSION, index, _digest_bytes(previous_hash), _digest_bytes(merkle_root), timestamp, target.to_bytes(32, "big")
+    )
+
+
+def encode_nonce(nonce):
+    return NONCE.pack(nonce)
+
+
+def decode_header(data, offset=0):
+    version, index, previous_hash, merkle_root, timestamp, target = HEADER_PREFIX.unpack_from(data, offset)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported block format version {version}")
+    nonce, = NONCE.unpack_from(data, offset + HEADER_PREFIX.size)
+    return {
+        "index": index,
+        "previous_hash": previous_hash.hex(),
+        "merkle_root": merkle_root.hex(),
+        "timestamp": timestamp,
+        "target": int.from_bytes(target, "big"),
+        "nonce": nonce
+    }
+
+
+def _has_file_fields(tx):
+    return (
+        isinstance(tx["user"], str) and isinstance(tx["v_file"], str)
+        and isinstance(tx["file_size"], int) and not isinstance(tx["file_size"], bool)
+        and 0 <= tx["file_size"] < 2 ** 64
+    )
+
+
+# All digests as raw bytes in one pass, or None unless every one is a lowercase sha256
+# hex digest. The round trip through hex rejects the uppercase and whitespace that
+# bytes.fromhex would take.
+def _digests_bytes(values):
+    try:
+        joined = "".join(values)
+        raw = bytes.fromhex(joined)
+    except (TypeError, ValueError):
+        return None
+    if raw.hex() != joined or set(map(len, values)) - {64}:
+        return None
+    return raw
+
+
+# The raw Merkle root followed by the raw `digests` of a file transaction, or None
+# unless its fields fit the structured encodings
+def _file_digests(tx, digests):
+    if not _has_file_fields(tx):
+        return None
+    return _digests_bytes([tx["merkle_root"], *digests])
+
+
+def _json_transaction(tx):
+    return bytes([TX_JSON]) + json.dumps(tx, sort_keys=True).encode()
+
+
+def encode_transaction(tx):
+    digests = None
+    if isinstance(tx, dict):
+        if "ref_tx" not in tx and tx.keys() >= _TX_KEYS and isinstance(tx["chunks"], list):
+            kind, fields = TX_STRUCTURED, _TX_FIELDS
+            digests = _file_digests(tx, tx["chunks"])
+        elif "chunks" not in tx and tx.keys() >= _REF_KEYS:
+            kind, fields = TX_REF, _REF_FIELDS
+            digests = _file_digests(tx, [tx["ref_tx"]])
+    if digests is None:
+        return _json_transaction(tx)
+    try:
+        user, v_file = tx["user"].encode(), tx["v_file"].encode()
+    except UnicodeEncodeError:
+        return _json_transaction(tx)
+    # Strings longer than their 16 bit length prefix stay in the JSON form
+    if len(user) > 0xFFFF or len(v_file) > 0xFFFF:
+        return _json_transaction(tx)
+
+    # Required fields are all present, so only a longer dict carries extras
+    extra = {k: v for k, v in tx.items() if k not in fields} if len(tx) > len(fields) else None
+    extra = json.dumps(extra, sort_keys=True).encode() if extra else b""
+    return b"".join([
+        _KIND_AND_LENGTH.pack(kind, len(user)), user,
+        U16.pack(len(v_file)), v_file,
+        U64.pack(tx["file_size"]), digests[:32],
+        U32.pack(len(tx["chunks"])) if kind == TX_STRUCTURED else b"", digests[32:],
+        U32.pack(len(extra)), extra
+    ])
+
+
+def decode_transaction(data):
+    data = bytes(data)
+    kind = data[0]
+    if kind == TX_JSON:
+        return json.loads(data[1:])
+    if kind not in (TX_STRUCTURED, TX_REF):
+        raise ValueError(f"Unknown transaction encoding {kind}")
+
+    # Fields are sliced at running offsets; a short record fails the next unpack or the final length check
+    try:
+        _, length = _KIND_AND_LENGTH.unpack_from(data)
+        offset = _KIND_AND_LENGTH.size + length
+        user = data[_KIND_AND_LENGTH.size:offset].decode()
+        length, = U16.unpack_from(data, offset)
+        v_file = data[offset + U16.size:offset + U16.size + length].decode()
+        offset += U16.size + length
+        file_size, merkle_root = _SIZE_AND_ROOT.unpack_from(data, offset)
+        offset += _SIZE_AND_ROOT.size
+        if kind == TX_REF:
+            body = {"ref_tx": data[offset:offset + 32].hex()}
+            offset += 32
+        else:
+            count, = U32.unpack_from(data, offset)
+            offset += U32.size
+            chunks = data[offset:offset + 32 * count].hex()
+            body = {"chunks": [chunks[i:i + 64] for i in range(0, len(chunks), 64)]}
+            offset += 32 * count
+        length, = U32.unpack_from(data, offset)
+        offset += U32.size
+    except struct.error:
+        raise ValueError("Truncated transaction")
+    if offset + length > len(data):
+        raise ValueError("Truncated transaction")
+
+    tx = json.loads(data[offset:offset + length]) if length else {}
+    tx.update({"user": user, "v_file": v_file, "file_size": file_size, "merkle_root": merkle_root.hex()})
+    tx.update(body)
+    return tx
+
+
+def encode_header(block):
+    prefix = encode_header_prefix(block.index, block.previous_hash, block.merkle_root, block.timestamp, block.target)
+    return prefix + encode_nonce(block.nonce)
+
+
+# Header plus transaction count, what /chain serves when only headers are asked for
+def encode_header_record(block):
+    return encode_header(block) + U32.pack(len(block.transactions))
+
+
+# The header record of an encoded block, full or pruned, cut out of it without decoding
+# any transaction. `data` needs only the first HEADER_RECORD_SIZE + 1 bytes of the block.
+def header_record(data):
+    offset = 1 if data[0] == PRUNED_RECORD else 0
+    record = bytes(data[offset:offset + HEADER_RECORD_SIZE])
+    if len(record) != HEADER_RECORD_SIZE:
+        raise ValueError("Truncated block")
+    return record
+
+
+def decode_header_record(data):
+    header = decode_header(data)
+    header["hash"] = sha256(data[:HEADER_SIZE]).hexdigest()
+    header["tx_count"], = U32.unpack_from(data, HEADER_SIZE)
+    return header
+
+
+def encode_block(block):
+    parts = [encode_header(block), U32.pack(len(block.transactions))]
+    for tx in block.transactions:
+        raw = encode_transaction(tx)
+        parts.append(U32.pack(len(raw)))
+        parts.append(raw)
+    return b"".join(parts)
+
+
+# Returns the keyword arguments for Block and the offset just past the block
+def decode_block_fields(data, offset=0):
+    fields = decode_header(data, offset)
+    offset += HEADER_SIZE
+    count, = U32.unpack_from(data, offset)
+    offset += U32.size
+    transactions = []
+    for _ in range(count):
+        length, = U32.unpack_from(data, offset)
+        offset += U32.size
+        if offset + length > len(data):
+            raise ValueError("Truncated block")
+        transactions.append(decode_transaction(data[offset:offset + length]))
+        offset += length
+    fields["transactions"] = transactions
+    return fields, offset
+
+
+# Pruned blocks keep their header and, per transaction, a flag saying whether it was
+# cut down to a summary. A summary is preceded by the hash of the original
+# transaction, so the Merkle root can still be checked and proven; a transaction kept
+# whole is hashed from its encoding as usual.
+TX_WHOLE = 0
+TX_SUMMARY = 1
+TX_MANIFEST = 2  # a summary that dropped the chunk list of its file, see encode_summary
+
+
+# Whether a summary is a file manifest without its chunk list. Its content hash, the
+# Merkle root of those chunks, is what remains of them.
+def _drops_chunks(summary):
+    return isinstance(summary, dict) and "merkle_root" in summary and "chunks" not in summary and "ref_tx" not in summary
+
+
+# Flag and encoding of a transaction summary in a pruned block. A manifest without
+# its chunk list is encoded as a file transaction listing no chunks, which keeps the
+# fixed width fields, and gets its own flag so decoding leaves the list out again.
+def encode_summary(summary):
+    if _drops_chunks(summary):
+        return TX_MANIFEST, encode_transaction(dict(summary, chunks=[]))
+    return TX_SUMMARY, encode_transaction(summary)
+
+
+def encode_pruned_block(block):
+    parts = [bytes([PRUNED_RECORD]), encode_header(block), U32.pack(len(block.transactions))]
+    for tx_hash, tx in zip(block.summary_hashes(), block.transactions):
+        if tx_hash is None:
+            raw = encode_transaction(tx)
+            parts += [bytes([TX_WHOLE]), U32.pack(len(raw)), raw]
+        else:
+            flag, raw = encode_summary(tx)
+            parts += [bytes([flag]), _digest_bytes(tx_hash), U32.pack(len(raw)), raw]
+    return b"".join(parts)
+
+
+def decode_pruned_block_fields(data):
+    fields = decode_header(data, 1)
+    offset = 1 + HEADER_SIZE
+    count, = U32.unpack_from(data, offset)
+    offset += U32.size
+    tx_hashes, transactions = [], []
+    for _ in range(count):
+        tx_hash, flag = None, data[offset]
+        if flag != TX_WHOLE:
+            tx_hash = bytes(data[offset + 1:offset + 33]).hex()
+            offset += 32
+        offset += 1
+        length, = U32.unpack_from(data, offset)
+        offset += U32.size
+        if offset + length > len(data):
+            raise ValueError("Truncated block")
+        tx = decode_transaction(data[offset:offset + length])
+        if flag == TX_MANIFEST:
+            tx.pop("chunks", None)
+        tx_hashes.append(tx_hash)
+        transactions.append(tx)
+        offset += length
+    fields["transactions"] = transactions
+    fields["tx_hashes"] = tx_hashes
+    return fields
+
+
+# User, content hash and chunk digests of a transaction, what the chain indexes keep
+def transaction_keys(tx):
+    chunks = tx.get("chunks")
+    chunks = [c for c in chunks if isinstance(c, str)] if isinstance(chunks, list) else []
+    return tx.get("user"), tx.get("merkle_root"), chunks
+
+
+# transaction_keys of an encoded transaction, read without decoding the rest; the
+# chunks are only read when `with_chunks` is set
+def _transaction_keys(raw, with_chunks):
+    if raw[0] == TX_JSON:
+        user, content_hash, chunks = transaction_keys(json.loads(bytes(raw[1:])))
+        return user, content_hash, chunks if with_chunks else []
+    length, = U16.unpack_from(raw, 1)
+    user = bytes(raw[1 + U16.size:1 + U16.size + length]).decode()
+    offset = 1 + U16.size + length
+    length, = U16.unpack_from(raw, offset)
+    offset += U16.size + length + U64.size
+    content_hash = bytes(raw[offset:offset + 32]).hex()
+    chunks = []
+    if with_chunks and raw[0] == TX_STRUCTURED:
+        count, = U32.unpack_from(raw, offset + 32)
+        offset += 32 + U32.size
+        digests = bytes(raw[offset:offset + 32 * count]).hex()
+        chunks = [digests[i:i + 64] for i in range(0, len(digests), 64)]
+    return user, content_hash, chunks
+
+
+# Header fields with the block hash, whether the block is pruned, and (tx hash, user,
+# content hash, chunks) per transaction of an encoded full or pruned block. A transaction's
+# hash is the sha256 of its encoding, so nothing is decoded; this is all the chain
+# indexes and the block tree need. Chunks are None for a summary that dropped them.
+def scan_block(data, with_chunks=False):
+    data = memoryview(data)
+    pruned = data[0] == PRUNED_RECORD
+    offset = 1 if pruned else 0
+    header = decode_header(data, offset)
+    header["hash"] = sha256(data[offset:offset + HEADER_SIZE]).hexdigest()
+    offset += HEADER_SIZE
+    count, = U32.unpack_from(data, offset)
+    offset += U32.size
+    entries = []
+    for _ in range(count):
+        tx_hash, flag = None, TX_WHOLE
+        if pruned:
+            flag = data[offset]
+            if flag != TX_WHOLE:
+                tx_hash = bytes(data[offset + 1:offset + 33]).hex()
+                offset += 32
+            offset += 1
+        length, = U32.unpack_from(data, offset)
+        offset += U32.size
+        raw = data[offset:offset + length]
+        if len(raw) != length:
+            raise ValueError("Truncated block")
+        offset += length
+        user, content_hash, chunks = _transaction_keys(raw, with_chunks)
+        entries.append((tx_hash or sha256(raw).hexdigest(), user, content_hash, None if flag == TX_MANIFEST else chunks))
+    return header, pruned, entries
+
+
+# Pages of blocks or headers: a count followed by length prefixed records
+def encode_records(records):
+    return U32.pack(len(records)) + b"".join(U32.pack(len(r)) + r for r in records)
+
+
+def decode_records(data):
+    count, = U32.unpack_from(data, 0)
+    offset = U32.size
+    records = []
+    for _ in range(count):
+        length, = U32.unpack_from(data, offset)
+        offset += U32.size
+        records.append(bytes(data[offset:offset + length]))
+        offset += length
+    return records
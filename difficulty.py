@@ -0,0 +1,69 @@
+import time
+
+# Proof of work targets. A block hash, read as a 256-bit big-endian integer, must be
+# below the block's target; the target is retargeted every `interval` blocks so the
+# observed block time tracks `block_time` as mining capacity changes.
+
+POW_LIMIT = 2 ** 252  # easiest target allowed, one leading zero hex digit
+MAX_ADJUSTMENT = 4  # a retarget moves the target by at most this factor either way
+MAX_FUTURE_DRIFT = 2 * 60 * 60  # seconds a block timestamp may run ahead of our clock
+
+
+# Target equivalent to requiring `zeros` leading zero hex digits
+def target_for_zeros(zeros):
+    return 2 ** (256 - 4 * zeros)
+
+
+def meets_target(block_hash, target):
+    return int(block_hash, 16) < target
+
+
+# Expected number of hashes to find a block below `target`
+def work_for(target):
+    return 2 ** 256 // target
+
+
+class DifficultySchedule:
+    def __init__(self, initial_target, interval, block_time, max_adjustment=MAX_ADJUSTMENT, limit=POW_LIMIT):
+        self.initial_target = initial_target
+        self.interval = interval
+        self.block_time = block_time
+        self.max_adjustment = max_adjustment
+        self.limit = limit
+
+    def is_retarget_height(self, height):
+        return height > 0 and height % self.interval == 0
+
+    # Target the child of `parent` must carry. `get_block` maps a hash to a block on the
+    # same branch and is only used at retarget heights, to find the start of the window.
+    def next_target(self, parent, get_block):
+        if parent is None:
+            return self.initial_target
+        height = parent.index + 1
+        if not self.is_retarget_height(height):
+            return parent.target
+
+        # The window starts after genesis, whose timestamp is fixed and says nothing about hash rate
+        first = parent
+        while first.index > max(1, height - self.interval):
+            first = get_block(first.previous_hash)
+            if first is None:
+                raise KeyError(f"Missing ancestor of block {parent.hash}")
+        blocks = parent.index - first.index
+        if blocks <= 0:
+            return parent.target
+
+        expected = blocks * self.block_time
+        actual = parent.timestamp - first.timestamp
+        actual = min(max(actual, expected / self.max_adjustment), expected * self.max_adjustment)
+        target = parent.target * int(actual * 1000) // int(expected * 1000)
+        return min(max(target, 1), self.limit)
+
+
+def timestamp_after(parent):
+    # Our clock may lag the parent's miner, block timestamps must still increase
+    return max(time.time(), parent.timestamp + 0.001)
+
+
+def valid_timestamp(block, parent):
+    return block.timestamp > parent.timestamp and block.timestamp <= time.time() + MAX_FUTURE_DRIFT
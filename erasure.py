@@ -0,0 +1,94 @@
+import numpy as np
+
+# Systematic Reed-Solomon erasure code over GF(2^8). k equally sized data shards
+# are kept as they are and m parity shards are added; any k of the k + m shards
+# rebuild the data. Parity rows come from a Cauchy matrix, so every k x k
+# submatrix of the generator is invertible.
+
+POLYNOMIAL = 0x11d  # x^8 + x^4 + x^3 + x^2 + 1
+MAX_SHARDS = 256  # k + m, every shard needs a distinct field element
+
+_EXP = np.zeros(512, dtype=np.uint8)
+_LOG = np.zeros(256, dtype=np.int32)
+_value = 1
+for _power in range(255):
+    _EXP[_power] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= POLYNOMIAL
+_EXP[255:510] = _EXP[:255]
+
+# _MUL[a] maps every byte b to a * b, so a shard is scaled with one table lookup
+_MUL = np.zeros((256, 256), dtype=np.uint8)
+_MUL[1:, 1:] = _EXP[(_LOG[1:, None] + _LOG[None, 1:]) % 255]
+
+
+def gf_mul(a, b):
+    return int(_MUL[a, b])
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return int(_EXP[255 - _LOG[a]])
+
+
+# Rows of the k + m by k generator: identity for the data shards, then Cauchy rows
+def generator(k, m):
+    if k < 1 or m < 0 or k + m > MAX_SHARDS:
+        raise ValueError(f"Unsupported erasure code {k}+{m}")
+    identity = [[int(i == j) for j in range(k)] for i in range(k)]
+    return identity + [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+
+def _invert(matrix):
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("Shard matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, v) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+# Each output shard is the GF(256) dot product of a matrix row with the input shards
+def _combine(matrix, shards):
+    out = []
+    for row in matrix:
+        acc = np.zeros(len(shards[0]), dtype=np.uint8)
+        for coefficient, shard in zip(row, shards):
+            if coefficient == 1:
+                acc ^= shard
+            elif coefficient:
+                acc ^= _MUL[coefficient][shard]
+        out.append(acc.tobytes())
+    return out
+
+
+# The m parity shards for k data shards of equal length
+def encode(data_shards, m):
+    k = len(data_shards)
+    if len({len(shard) for shard in data_shards}) > 1:
+        raise ValueError("Data shards must have the same length")
+    shards = [np.frombuffer(shard, dtype=np.uint8) for shard in data_shards]
+    return _combine(generator(k, m)[k:], shards)
+
+
+# The k data shards from any k of the k + m shards, given as {shard index: bytes}
+def decode(shards, k, m):
+    available = sorted(shards)[:k]
+    if len(available) < k:
+        raise ValueError(f"{len(shards)} shards available, {k} needed")
+    if available == list(range(k)):
+        return [bytes(shards[i]) for i in available]
+    rows = generator(k, m)
+    inverse = _invert([rows[i] for i in available])
+    return _combine(inverse, [np.frombuffer(shards[i], dtype=np.uint8) for i in available])
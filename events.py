@@ -0,0 +1,79 @@
+import json
+import queue
+import threading
+from collections import deque
+
+HISTORY_SIZE = 1000  # recent events kept so a reconnecting subscriber can catch up
+SUBSCRIBER_QUEUE = 1000  # events buffered per subscriber before it is dropped
+KEEPALIVE = 15  # seconds between comments on an idle stream
+
+
+class Event:
+    __slots__ = ("id", "kind", "data")
+
+    def __init__(self, id, kind, data):
+        self.id = id
+        self.kind = kind
+        self.data = data
+
+    # Server-sent events wire format
+    def encode(self):
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {json.dumps(self.data, sort_keys=True)}\n\n"
+
+
+# In-process publish/subscribe for node events. Every subscriber gets its own
+# bounded queue; one that falls too far behind is cut off and has to reconnect,
+# replaying what it missed from the history by event id.
+class EventBus:
+    def __init__(self, history_size=HISTORY_SIZE, queue_size=SUBSCRIBER_QUEUE):
+        self.queue_size = queue_size
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def publish(self, kind, data):
+        with self._lock:
+            event = Event(self._next_id, kind, data)
+            self._next_id += 1
+            self._history.append(event)
+            for subscriber in list(self._subscribers):
+                if subscriber.qsize() >= self.queue_size:
+                    # The spare slot takes the marker that ends its stream
+                    self._subscribers.discard(subscriber)
+                    subscriber.put_nowait(None)
+                else:
+                    subscriber.put_nowait(event)
+        return event
+
+    # Returns a queue receiving every event after `last_id` (None for new events only)
+    def subscribe(self, last_id=None):
+        subscriber = queue.Queue(maxsize=self.queue_size + 1)
+        with self._lock:
+            if last_id is not None:
+                missed = [event for event in self._history if event.id > last_id]
+                for event in missed[-self.queue_size:]:
+                    subscriber.put_nowait(event)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    # SSE body for one subscriber, ends when it is cut off
+    def stream(self, last_id=None, keepalive=KEEPALIVE):
+        subscriber = self.subscribe(last_id)
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                try:
+                    event = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield event.encode()
+        finally:
+            self.unsubscribe(subscriber)
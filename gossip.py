@@ -0,0 +1,44 @@
+import random
+import threading
+from collections import OrderedDict
+
+SEEN_CACHE_SIZE = 10000  # ids remembered per node
+GOSSIP_FANOUT = 3  # peers an announcement is forwarded to per hop
+
+
+# Bounded LRU of item ids this node has already seen, so an announcement is
+# fetched and forwarded at most once.
+class SeenCache:
+    def __init__(self, max_size=SEEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, item_id):
+        with self._lock:
+            return item_id in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    # Returns True if the id was not seen before
+    def add(self, item_id):
+        with self._lock:
+            if item_id in self._items:
+                self._items.move_to_end(item_id)
+                return False
+            self._items[item_id] = True
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return True
+
+    def discard(self, item_id):
+        with self._lock:
+            self._items.pop(item_id, None)
+
+
+def choose_peers(peers, fanout=GOSSIP_FANOUT, exclude=()):
+    candidates = [p for p in peers if p not in exclude]
+    if len(candidates) <= fanout:
+        return candidates
+    return random.sample(candidates, fanout)
@@ -0,0 +1,235 @@
+import argparse
+import os
+import threading
+import requests
+import codec
+from Block import Block, GENESIS_PREVIOUS_HASH, transaction_hash
+from difficulty import DifficultySchedule, target_for_zeros, work_for
+from merkle import merkle_root, verify_proof
+from params import INITIAL_DIFFICULTY, RETARGET_INTERVAL, TARGET_BLOCK_TIME, GENESIS_TIMESTAMP
+from validation import check_header, check_context
+
+SYNC_PAGE = 500  # headers per request, the most a node returns at once
+MIN_CONFIRMATIONS = 1  # blocks at and above a transaction's block before it counts as proven
+RECORD_SIZE = codec.HEADER_SIZE + 4  # header followed by its transaction count, as served by /chain
+
+
+def header_block(record):
+    fields = codec.decode_header_record(record)
+    del fields["tx_count"]
+    return Block(transactions=[], **fields)
+
+
+def branch_work(headers):
+    return sum(work_for(header.target) for header in headers)
+
+
+# Follows a full node by block headers alone (125 bytes per block) and checks
+# transactions against them with Merkle proofs, so a node that only needs to prove
+# storage never downloads block bodies or file chunks. Headers are checked the way
+# a full node checks them (linkage, proof of work, retargeting and timestamps) from
+# the fixed genesis block, so the full node is only trusted to serve data, not to
+# vouch for it. With a `path` the headers are kept on disk and a restart fetches
+# only the new ones.
+class LightClient:
+    def __init__(self, node_url, path=None, schedule=None, timeout=10):
+        self.node_url = node_url.rstrip("/")
+        self.path = path
+        self.timeout = timeout
+        self.schedule = schedule or DifficultySchedule(
+            target_for_zeros(INITIAL_DIFFICULTY), RETARGET_INTERVAL, TARGET_BLOCK_TIME)
+        self.genesis = Block(0, [], GENESIS_PREVIOUS_HASH, timestamp=GENESIS_TIMESTAMP,
+                             target=self.schedule.initial_target)
+        self.headers = [self.genesis]
+        self.by_hash = {self.genesis.hash: self.genesis}
+        self.session = requests.Session()
+        self._lock = threading.RLock()
+        if path:
+            self._load()
+
+    @property
+    def height(self):
+        return len(self.headers) - 1
+
+    @property
+    def tip(self):
+        return self.headers[-1]
+
+    # ------------------------ storage ------------------------
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as f:
+                f.write(codec.encode_header_record(self.genesis))
+            return
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        headers = []
+        for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            header = header_block(data[offset:offset + RECORD_SIZE])
+            # Headers were checked before they were written, only a torn write at the end is cut
+            if header.index != len(headers) or (headers and header.previous_hash != headers[-1].hash):
+                break
+            headers.append(header)
+        if not headers or headers[0].hash != self.genesis.hash:
+            raise ValueError(f"{self.path} does not start at the genesis block")
+
+        self.headers = headers
+        self.by_hash = {header.hash: header for header in headers}
+        if len(data) != len(headers) * RECORD_SIZE:
+            with open(self.path, "r+b") as f:
+                f.truncate(len(headers) * RECORD_SIZE)
+
+    # Replaces the headers from `height` up with `branch`
+    def _replace(self, height, branch, records):
+        for header in self.headers[height:]:
+            self.by_hash.pop(header.hash, None)
+        self.headers[height:] = branch
+        self.by_hash.update((header.hash, header) for header in branch)
+        if self.path:
+            with open(self.path, "r+b") as f:
+                f.truncate(height * RECORD_SIZE)
+                f.seek(0, os.SEEK_END)
+                f.write(b"".join(records))
+                f.flush()
+                os.fsync(f.fileno())
+
+    # ------------------------ sync ------------------------
+
+    def _get(self, path, **kwargs):
+        response = self.session.get(f"{self.node_url}{path}", timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    # Raw header records for heights from_index .. from_index + limit - 1
+    def fetch_headers(self, from_index, limit):
+        response = self._get("/chain", params={"from_index": from_index, "limit": limit, "headers_only": 1},
+                             headers={"Accept": codec.BINARY_MIMETYPE})
+        if not response.headers.get("Content-Type", "").startswith(codec.BINARY_MIMETYPE):
+            raise ValueError("Node did not return binary headers")
+        records = codec.decode_records(response.content)
+        if any(len(record) != RECORD_SIZE for record in records):
+            raise ValueError("Node returned a malformed header")
+        return records
+
+    # Height of the last header we share with the node, walking back a page at a time
+    def _common_ancestor(self, node_length):
+        height = min(self.height, node_length - 1)
+        while height >= 0:
+            start = max(0, height - SYNC_PAGE + 1)
+            for record in reversed(self.fetch_headers(start, height - start + 1)):
+                header = codec.decode_header_record(record)
+                if header["index"] <= self.height and header["hash"] == self.headers[header["index"]].hash:
+                    return header["index"]
+            height = start - 1
+        raise ValueError("Node does not share our genesis block")
+
+    def _valid_branch(self, parent, branch):
+        added = {}
+
+        def get_block(block_hash):
+            return added.get(block_hash) or self.by_hash.get(block_hash)
+
+        for header in branch:
+            if header.index != parent.index + 1 or header.previous_hash != parent.hash:
+                return False
+            if not check_header(header) or not check_context(header, parent, self.schedule, get_block):
+                return False
+            added[header.hash] = header
+            parent = header
+        return True
+
+    # Fetches and checks the headers past the last one we share with the node, and
+    # switches to them if they carry more work. Returns the number of headers added.
+    def sync(self):
+        with self._lock:
+            node_length = self._get("/chain/tip").json()["length"]
+            fork = self._common_ancestor(node_length)
+
+            records = []
+            while fork + 1 + len(records) < node_length:
+                start = fork + 1 + len(records)
+                page = self.fetch_headers(start, min(SYNC_PAGE, node_length - start))
+                if not page:
+                    break
+                records += page
+            branch = [header_block(record) for record in records]
+
+            if not self._valid_branch(self.headers[fork], branch):
+                raise ValueError("Node served an invalid header chain")
+            if branch_work(branch) <= branch_work(self.headers[fork + 1:]):
+                return 0
+            self._replace(fork + 1, branch, records)
+            return len(branch)
+
+    # ------------------------ verification ------------------------
+
+    # Checks the node's Merkle proof of `tx_hash` against our header of its block and
+    # returns the transaction with its block and confirmations. Raises ValueError when
+    # the transaction cannot be proven on the header chain.
+    def verify_transaction(self, tx_hash, min_confirmations=MIN_CONFIRMATIONS):
+        response = self.session.get(f"{self.node_url}/tx/{tx_hash}/proof", timeout=self.timeout)
+        if response.status_code == 404:
+            raise ValueError(f"Transaction {tx_hash} is not confirmed")
+        response.raise_for_status()
+        proof = response.json()
+
+        with self._lock:
+            header = self.headers[proof["block_index"]] if proof["block_index"] <= self.height else None
+            if header is None or header.hash != proof["block_hash"]:
+                # The node may be ahead of us or have switched branches since the last sync
+                self.sync()
+                header = self.headers[proof["block_index"]] if proof["block_index"] <= self.height else None
+            if header is None or header.hash != proof["block_hash"]:
+                raise ValueError(f"Block {proof['block_hash']} is not on the header chain")
+            confirmations = self.height - header.index + 1
+
+        if transaction_hash(proof["transaction"]) != tx_hash:
+            if proof.get("pruned"):
+                raise ValueError(f"Node has pruned the body of {tx_hash}, ask a node that keeps every block")
+            raise ValueError("Node returned a different transaction")
+        if not verify_proof(tx_hash, proof["proof"], header.merkle_root):
+            raise ValueError(f"Merkle proof of {tx_hash} does not match block #{header.index}")
+        if confirmations < min_confirmations:
+            raise ValueError(f"Transaction {tx_hash} has {confirmations} of {min_confirmations} confirmations")
+        return {
+            "tx_hash": tx_hash,
+            "transaction": proof["transaction"],
+            "block_index": header.index,
+            "block_hash": header.hash,
+            "confirmations": confirmations
+        }
+
+    # Proves that `tx_hash` put the content with Merkle root `content_hash` on chain,
+    # following a ref_tx to the transaction that listed its chunks
+    def verify_file(self, tx_hash, content_hash, min_confirmations=MIN_CONFIRMATIONS):
+        result = self.verify_transaction(tx_hash, min_confirmations)
+        stored = result
+        if "ref_tx" in result["transaction"]:
+            stored = self.verify_transaction(result["transaction"]["ref_tx"], min_confirmations)
+        for tx in (result["transaction"], stored["transaction"]):
+            if tx.get("merkle_root") != content_hash:
+                raise ValueError(f"Transaction {tx_hash} stores different content")
+        if merkle_root(stored["transaction"].get("chunks", [])) != content_hash:
+            raise ValueError(f"Chunk list of {stored['tx_hash']} does not match its content hash")
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync block headers from a node and verify transactions")
+    parser.add_argument("node", help="URL of a full node, e.g. http://127.0.0.1:8800")
+    parser.add_argument("tx_hashes", nargs="*", help="transactions to prove")
+    parser.add_argument("--headers", default="headers.dat", help="file the headers are kept in")
+    parser.add_argument("--confirmations", type=int, default=MIN_CONFIRMATIONS)
+    args = parser.parse_args()
+
+    client = LightClient(args.node, path=args.headers)
+    added = client.sync()
+    print(f"{added} new headers, tip #{client.height} {client.tip.hash}")
+    for tx_hash in args.tx_hashes:
+        try:
+            result = client.verify_transaction(tx_hash, args.confirmations)
+            print(f"{tx_hash}: in block #{result['block_index']} with {result['confirmations']} confirmations")
+        except ValueError as e:
+            print(f"{tx_hash}: {str(e)}")
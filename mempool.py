@@ -0,0 +1,117 @@
+import heapq
+import threading
+import time
+import codec
+from Block import transaction_hash
+
+MAX_TRANSACTIONS = 5000  # pending transactions kept at most
+MAX_BYTES = 16 * 1024 * 1024  # serialized size of all pending transactions
+
+
+class MempoolEntry:
+    def __init__(self, tx, tx_hash, size, added):
+        self.tx = tx
+        self.tx_hash = tx_hash
+        self.size = size
+        self.fee = tx.get("fee", 0) if isinstance(tx.get("fee", 0), (int, float)) else 0
+        self.added = added
+
+    # Higher fee per byte first, then older first
+    @property
+    def priority(self):
+        return (self.fee / self.size, -self.added)
+
+
+# Pending transactions indexed by hash, bounded by count and bytes. When full the
+# lowest priority entries are evicted, and blocks are filled highest priority first.
+class Mempool:
+    def __init__(self, max_count=MAX_TRANSACTIONS, max_bytes=MAX_BYTES):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = {}
+        self._eviction = []  # min-heap on priority, stale items are skipped lazily
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._entries
+
+    # Transactions in arrival order
+    def __iter__(self):
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: e.added)
+        return iter([e.tx for e in entries])
+
+    def get(self, tx_hash):
+        entry = self._entries.get(tx_hash)
+        return entry.tx if entry else None
+
+    def oldest(self):
+        with self._lock:
+            if not self._entries:
+                return None
+            return min(e.added for e in self._entries.values())
+
+    def add(self, tx):
+        tx_hash = transaction_hash(tx)
+        size = len(codec.encode_transaction(tx))
+        entry = MempoolEntry(tx, tx_hash, size, time.time())
+
+        with self._lock:
+            if tx_hash in self._entries:
+                raise ValueError("Transaction already pending")
+            if size > self.max_bytes:
+                raise ValueError("Transaction larger than the mempool")
+
+            while len(self._entries) >= self.max_count or self.bytes + size > self.max_bytes:
+                victim = self._lowest()
+                if victim.priority >= entry.priority:
+                    raise ValueError("Mempool full")
+                self._remove(victim.tx_hash)
+
+            self._entries[tx_hash] = entry
+            self.bytes += size
+            heapq.heappush(self._eviction, (entry.priority, tx_hash))
+            return tx_hash
+
+    def _lowest(self):
+        while True:
+            priority, tx_hash = self._eviction[0]
+            entry = self._entries.get(tx_hash)
+            if entry is not None and entry.priority == priority:
+                return entry
+            heapq.heappop(self._eviction)
+
+    def _remove(self, tx_hash):
+        entry = self._entries.pop(tx_hash, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        # Keep the lazy heap from growing past the live entries by much
+        if len(self._eviction) > 2 * len(self._entries) + 64:
+            self._eviction = [(e.priority, h) for h, e in self._entries.items()]
+            heapq.heapify(self._eviction)
+        return entry
+
+    def remove(self, tx_hashes):
+        with self._lock:
+            for tx_hash in tx_hashes:
+                self._remove(tx_hash)
+
+    # Highest priority transactions whose serialized size fits in `max_bytes`
+    def select(self, max_bytes, max_count=None):
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: e.priority, reverse=True)
+
+        selected = []
+        used = 0
+        for entry in entries:
+            if max_count is not None and len(selected) >= max_count:
+                break
+            if used + entry.size > max_bytes:
+                continue
+            selected.append(entry.tx)
+            used += entry.size
+        return selected
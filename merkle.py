@@ -0,0 +1,49 @@
+from hashlib import sha256
+
+# Merkle tree over hex encoded sha256 digests. When a level has an odd number
+# of nodes the last one is paired with itself, so leaves ending in a repeated
+# leaf share a root with the list without it: callers must reject duplicates.
+
+
+def hash_pair(left, right):
+    return sha256(bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def merkle_root(leaves):
+    if not leaves:
+        return sha256(b"").hexdigest()
+
+    level = list(leaves)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [hash_pair(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+# Sibling hashes needed to rebuild the root from the leaf at `index`.
+# Each step is [sibling, side] where side tells which side the sibling sits on.
+def merkle_proof(leaves, index):
+    if not 0 <= index < len(leaves):
+        raise IndexError("leaf index out of range")
+
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        sibling = index ^ 1
+        proof.append([level[sibling], "left" if sibling < index else "right"])
+        level = [hash_pair(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    current = leaf
+    for sibling, side in proof:
+        if side == "left":
+            current = hash_pair(sibling, current)
+        else:
+            current = hash_pair(current, sibling)
+    return current == root
@@ -0,0 +1,114 @@
+import multiprocessing as mp
+import os
+import queue
+import random
+import threading
+import time
+from hashlib import sha256
+from Block import Block
+
+NONCE_SPACE = 2 ** 63  # nonces are split into one contiguous range per worker
+BATCH_SIZE = 20000  # attempts between checks of the stop flag
+
+
+class MiningResult:
+    def __init__(self, nonce, hash, hashes, elapsed, workers):
+        self.nonce = nonce
+        self.hash = hash
+        self.hashes = hashes
+        self.elapsed = elapsed
+        self.workers = workers
+
+    @property
+    def found(self):
+        return self.hash is not None
+
+    @property
+    def hash_rate(self):
+        return self.hashes / self.elapsed if self.elapsed > 0 else 0.0
+
+
+# Scans nonces [start, stop) until a hash falls below `target` or another worker sets `found`
+def _search(prefix, target, start, stop, found, counter, results):
+    base = sha256(prefix)
+    from_bytes = int.from_bytes
+    encode_nonce = Block.encode_nonce
+    nonce = start
+    while nonce < stop and not found.is_set():
+        end = min(nonce + BATCH_SIZE, stop)
+        for n in range(nonce, end):
+            h = base.copy()
+            h.update(encode_nonce(n))
+            if from_bytes(h.digest(), "big") < target:
+                with counter.get_lock():
+                    counter.value += n - nonce + 1
+                found.set()
+                results.put((n, h.hexdigest()))
+                return
+        with counter.get_lock():
+            counter.value += end - nonce
+        nonce = end
+
+
+def _ranges(workers, rng):
+    span = NONCE_SPACE // workers
+    # Start each worker at a random point of its range so runs do not repeat the same nonces
+    return [(i * span + rng.randrange(span // 2), (i + 1) * span) for i in range(workers)]
+
+
+# Finds a nonce for `prefix` whose hash is below `target` using `workers` processes. `progress` is called with the
+# number of hashes tried so far and setting `cancel` (an Event) stops the search.
+def mine(prefix, target, workers=None, progress=None, cancel=None, poll_interval=0.1, seed=None):
+    workers = workers or os.cpu_count() or 1
+    rng = random.Random(seed)
+    start_time = time.perf_counter()
+
+    if workers == 1:
+        # A single worker runs in a thread, there is no point paying for process start-up
+        found, results = threading.Event(), queue.Queue()
+        spawn = threading.Thread
+    else:
+        found, results = mp.Event(), mp.Queue()
+        spawn = mp.Process
+    counter = mp.Value("Q", 0)
+
+    searchers = [
+        spawn(target=_search, args=(prefix, target, start, stop, found, counter, results), daemon=True)
+        for start, stop in _ranges(workers, rng)
+    ]
+    for s in searchers:
+        s.start()
+
+    nonce = digest = None
+    try:
+        while True:
+            try:
+                nonce, digest = results.get(timeout=poll_interval)
+                break
+            except queue.Empty:
+                if progress:
+                    progress(counter.value)
+                if cancel is not None and cancel.is_set():
+                    break
+                if not any(s.is_alive() for s in searchers) and results.empty():
+                    break
+    finally:
+        # Stop the remaining workers as soon as one of them has an answer
+        found.set()
+        for s in searchers:
+            s.join(timeout=1)
+            if s.is_alive() and spawn is mp.Process:
+                s.terminate()
+        if progress:
+            progress(counter.value)
+
+    return MiningResult(nonce, digest, counter.value, time.perf_counter() - start_time, workers)
+
+
+# Mines `block` in place against its own target and returns the MiningResult
+def mine_block(block, workers=None, progress=None, cancel=None):
+    result = mine(block.header_prefix(), block.target, workers=workers, progress=progress, cancel=cancel)
+    if result.found:
+        block.nonce = result.nonce
+        block.hash = result.hash
+    return result
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MAX_FINISHED_JOBS = 100  # finished jobs kept around for status queries
+
+
+class MiningJob:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"  # queued -> running -> done | empty | failed
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.hashes = 0
+        self.block = None
+        self.error = None
+
+    def to_dict(self):
+        now = self.finished or time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "hashes": self.hashes,
+            "elapsed": round(now - self.started, 3) if self.started else 0.0,
+            "block": self.block,
+            "error": self.error
+        }
+
+
+# Runs mining in a single background thread so request handlers never wait on PoW.
+# `mine` is called with a progress callback and returns a dict describing the block,
+# or None when there was nothing to mine.
+class MiningJobs:
+    def __init__(self, mine):
+        self._mine = mine
+        self._jobs = OrderedDict()
+        self._queue = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def submit(self):
+        with self._lock:
+            # A queued job will pick up everything pending when it runs, so reuse it
+            if self._queue:
+                return self._jobs[self._queue[0]]
+
+            job = MiningJob()
+            self._jobs[job.id] = job
+            self._queue.append(job.id)
+            self._ensure_thread()
+            self._wakeup.notify()
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self):
+        with self._lock:
+            return [j for j in self._jobs.values() if j.status in ("queued", "running")]
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="mining-jobs", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._wakeup.wait()
+                job = self._jobs[self._queue.pop(0)]
+                job.status = "running"
+                job.started = time.time()
+
+            def progress(hashes):
+                job.hashes = hashes
+
+            try:
+                block = self._mine(progress)
+                job.block = block
+                job.status = "done" if block else "empty"
+            except Exception as e:
+                logger.error(f"Mining job {job.id} failed: {str(e)}")
+                job.error = str(e)
+                job.status = "failed"
+            job.finished = time.time()
+            self._prune()
+
+    def _prune(self):
+        with self._lock:
+            finished = [j.id for j in self._jobs.values() if j.finished]
+            for job_id in finished[:-MAX_FINISHED_JOBS]:
+                del self._jobs[job_id]
+
+
+# Seals a block when the pending pool reaches `max_size` transactions or its oldest
+# transaction is older than `max_age` seconds. `pending_stats` returns (count, oldest_timestamp).
+class AutoMiner:
+    def __init__(self, jobs, pending_stats, max_size=0, max_age=0, interval=1.0):
+        self.jobs = jobs
+        self.pending_stats = pending_stats
+        self.max_size = max_size
+        self.max_age = max_age
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 or self.max_age > 0
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="auto-miner", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def should_mine(self):
+        count, oldest = self.pending_stats()
+        if count == 0:
+            return False
+        if self.max_size and count >= self.max_size:
+            return True
+        return bool(self.max_age and oldest is not None and time.time() - oldest >= self.max_age)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.jobs.active() and self.should_mine():
+                job = self.jobs.submit()
+                logger.info(f"Auto-miner started job {job.id}")
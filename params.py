@@ -0,0 +1,7 @@
+# Network parameters. Every node and light client must use the same values, or they
+# build different genesis blocks and disagree on targets.
+
+INITIAL_DIFFICULTY = 2  # leading hex zeros the genesis target asks for
+RETARGET_INTERVAL = 10  # blocks between target adjustments
+TARGET_BLOCK_TIME = 10.0  # seconds per block the target is adjusted towards
+GENESIS_TIMESTAMP = 0.0  # fixed so every node starts from the same genesis block
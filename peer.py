@@ -1,101 +1,626 @@
-import json
-from flask import Flask, jsonify, request
-from Block import Block
-from hashlib import sha256
+import functools
+import gc
+import os
+import pickle
+import threading
+import time
+import codec
+import snapshot
+from flask import Flask, Response, g, jsonify, request, send_file
+from Block import Block, GENESIS_PREVIOUS_HASH, transaction_hash
+from block_store import BlockLog
+from block_tree import BlockTree, MAX_SIDE_DEPTH
+from chain_index import ChainIndex
+from chunk_store import ChunkStore, is_digest
+from events import EventBus
+from difficulty import DifficultySchedule, target_for_zeros, timestamp_after, work_for
+from mempool import Mempool
+from params import INITIAL_DIFFICULTY, RETARGET_INTERVAL, TARGET_BLOCK_TIME, GENESIS_TIMESTAMP
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, SIZE_BUCKETS, Registry, SamplingProfiler
+from miner import mine_block
+from mining_jobs import MiningJobs, AutoMiner
+from peer_client import PeerClient
+from placement import HashRing, LayoutStore, build_layout, data_digests
+from validation import ChainValidator, check_transaction
+from gossip import SeenCache, choose_peers, GOSSIP_FANOUT as DEFAULT_FANOUT
 import logging
 import requests
+from urllib.parse import urlsplit
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 app.logger = logging.getLogger(__name__)
 
-peers = set()  # <-- Peer nodes
+NODE_PORT = int(os.environ.get("NODE_PORT", 8800))
+NODE_DEBUG = os.environ.get("NODE_DEBUG", "0") == "1"  # Flask debugger on the development server
+NODE_URL = os.environ.get("NODE_URL", f"http://127.0.0.1:{NODE_PORT}")  # address peers use to reach this node
+DATA_DIR = os.environ.get("NODE_DATA_DIR", "node_data")
+MINING_WORKERS = int(os.environ.get("NODE_MINING_WORKERS", 0)) or os.cpu_count() or 1
+AUTO_MINE_SIZE = int(os.environ.get("NODE_AUTO_MINE_SIZE", 0))  # seal a block at this many pending txs (0 = off)
+AUTO_MINE_AGE = float(os.environ.get("NODE_AUTO_MINE_AGE", 0))  # or once the oldest pending tx is this old, in seconds
+MEMPOOL_MAX_TXS = int(os.environ.get("NODE_MEMPOOL_MAX_TXS", 5000))
+MEMPOOL_MAX_BYTES = int(os.environ.get("NODE_MEMPOOL_MAX_BYTES", 16 * 1024 * 1024))
+MAX_BLOCK_BYTES = int(os.environ.get("NODE_MAX_BLOCK_BYTES", 1024 * 1024))  # serialized transactions per block
+VALIDATION_WORKERS = int(os.environ.get("NODE_VALIDATION_WORKERS", 1))  # processes checking block bodies during sync
+MAX_CHAIN_PAGE = 500  # most blocks returned by one /chain request when a limit is given
+SYNC_PAGE = 100  # blocks or headers fetched per request while syncing from a peer
+PEER_TIMEOUT = float(os.environ.get("NODE_PEER_TIMEOUT", 5))  # seconds per call to a peer
+BROADCAST_QUORUM = int(os.environ.get("NODE_BROADCAST_QUORUM", 1))  # peer replies to wait for when broadcasting
+GOSSIP_FANOUT = int(os.environ.get("NODE_GOSSIP_FANOUT", DEFAULT_FANOUT))  # peers each announcement is forwarded to
+MAX_PEERS = int(os.environ.get("NODE_MAX_PEERS", 32))  # registered peers kept at most, further registrations are refused
+PROFILE_INTERVAL = float(os.environ.get("NODE_PROFILE_INTERVAL", 0))  # seconds between profiler samples (0 = off)
+PRUNE_DEPTH = int(os.environ.get("NODE_PRUNE_DEPTH", 0))  # full blocks kept below the tip, older ones are pruned (0 = off)
+if PRUNE_DEPTH:
+    # A reorg undoes the blocks above its fork, and side branches are kept this deep
+    PRUNE_DEPTH = max(PRUNE_DEPTH, MAX_SIDE_DEPTH)
+PRUNE_BATCH = 100  # blocks pruned at once, a pass that shrinks any of them rewrites the block log
+PRUNED_HEIGHT_PATH = os.path.join(DATA_DIR, "pruned_height")
+STATE_PATH = os.path.join(DATA_DIR, "chain.state")  # indexes and block tree as of some height, next to chain.idx
+STATE_VERSION = 2
+STATE_INTERVAL = 1000  # connected blocks between two saves of the state
+SNAPSHOT_KEY = os.environ.get("NODE_SNAPSHOT_KEY", "").encode()  # HMAC key of /snapshot (empty = no snapshots)
+SNAPSHOT_TIMEOUT = 120  # seconds allowed for downloading a snapshot
+SNAPSHOT_INTERVAL = 100  # snapshot heights are multiples of this, so one is reused for that many blocks
+SNAPSHOT_PATH = os.path.join(DATA_DIR, "snapshot")  # last snapshot served, or downloaded while bootstrapping
+BOOTSTRAP_URL = os.environ.get("NODE_BOOTSTRAP_URL", "")  # node an empty node loads its first snapshot from
+ERASURE_CODE = os.environ.get("NODE_ERASURE", "")  # "k+m" data and parity shards per stripe of a file (empty = full copies)
+ERASURE = tuple(int(n) for n in ERASURE_CODE.split("+")) if ERASURE_CODE else None
+
+peers = set()  # <-- Peer nodes, guarded by peers_lock
+peers_lock = threading.Lock()
+chunk_store = ChunkStore(os.path.join(DATA_DIR, "chunks"))
+layouts = LayoutStore(os.path.join(DATA_DIR, "layouts"), NODE_URL)  # where the shards of erasure coded files live
+
+# ------------------------ METRICS ------------------------
+
+metrics = Registry()  # exposed at /metrics
+http_requests = metrics.counter("node_http_requests_total", "HTTP requests handled", ("method", "endpoint", "status"))
+http_latency = metrics.histogram("node_http_request_duration_seconds", "Time to produce a response", ("method", "endpoint"))
+mining_hashes = metrics.counter("node_mining_hashes_total", "Proof of work hashes computed")
+mining_hash_rate = metrics.gauge("node_mining_hash_rate", "Hashes per second of the last mining run")
+mining_duration = metrics.histogram("node_mining_duration_seconds", "Time spent mining a block",
+                                    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+blocks_mined = metrics.counter("node_blocks_mined_total", "Blocks mined by this node")
+block_bytes = metrics.histogram("node_block_bytes", "Encoded size of connected blocks", buckets=SIZE_BUCKETS)
+block_transactions = metrics.histogram("node_block_transactions", "Transactions per connected block",
+                                       buckets=(0, 1, 10, 100, 1000, 10000))
+transactions_rejected = metrics.counter("node_transactions_rejected_total", "Transactions that failed validation")
+peer_latency = metrics.histogram("node_peer_request_duration_seconds", "Round trip time of calls to peers", ("peer",))
+peer_failures = metrics.counter("node_peer_request_failures_total", "Calls to peers that got no response", ("peer",))
+shards_placed = metrics.counter("node_shards_placed_total", "Erasure coded shards stored on nodes, this one included")
+profiler = SamplingProfiler(PROFILE_INTERVAL)  # served at /debug/profile when enabled
+
+def observe_peer_call(peer, seconds, ok):
+    peer_latency.labels(peer).observe(seconds)
+    if not ok:
+        peer_failures.labels(peer).inc()
+
+peer_client = PeerClient(timeout=PEER_TIMEOUT, observe=observe_peer_call)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+# Labelled by route pattern, so /tx/<tx_hash> is one series however many hashes are asked for.
+# Streamed responses (/events) are timed up to their first byte.
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    http_requests.labels(request.method, endpoint, response.status_code).inc()
+    if "request_start" in g:
+        http_latency.labels(request.method, endpoint).observe(time.perf_counter() - g.request_start)
+    return response
+seen = SeenCache()  # "tx:<hash>" and "block:<hash>" ids already fetched or announced
+events = EventBus()  # block_connected, block_disconnected and tx_accepted, streamed at /events
+schedule = DifficultySchedule(target_for_zeros(INITIAL_DIFFICULTY), RETARGET_INTERVAL, TARGET_BLOCK_TIME)
+
+# Runs a Blockchain method under the chain lock. Request threads, the miner and gossip
+# all touch the chain, so every change and every multi-step read holds it.
+def synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class Blockchain:
     def __init__(self):
-        self.chain = []
-        self.pending = []
-        self.create_genesis_block()
+        self.lock = threading.RLock()
+        # Blocks are persisted in an append-only log and loaded lazily on access
+        self.chain = BlockLog(os.path.join(DATA_DIR, "chain"))
+        self.pending = Mempool(max_count=MEMPOOL_MAX_TXS, max_bytes=MEMPOOL_MAX_BYTES)
+        if not len(self.chain):
+            if BOOTSTRAP_URL:
+                self.bootstrap(BOOTSTRAP_URL)
+            else:
+                self.create_genesis_block()
+        self.index = ChainIndex(track_chunks=bool(ERASURE))
+        self.tree = BlockTree(block_work)
+        self.pruned_height = self.load_pruned_height()  # blocks below this height are pruned where that saves space
+        self._snapshot_height = None  # height of the snapshot at SNAPSHOT_PATH
+        self._snapshot_lock = threading.Lock()  # one snapshot is written at a time
+        self.tip_changed = threading.Event()  # set on every connected block, stops the running PoW search
+        # Loaded from the last saved state, only the blocks after it are scanned. They are
+        # read from block headers and the hashes of the encoded transactions, so start-up
+        # does not decode any transaction.
+        self.state_height = self.load_state()  # blocks covered by the saved state
+        for payload in self.chain.payloads(self.state_height):
+            header, pruned, entries = codec.scan_block(payload, with_chunks=bool(ERASURE))
+            self.index.connect_entries(header["index"], header["hash"], entries)
+            self.tree.add(Block(transactions=[], **header))
+            if pruned:
+                self.pruned_height = max(self.pruned_height, header["index"] + 1)
+        self.tree.tip = self.last_block.hash
+        self.tree.forget_below(self.pruned_height - 1)
+        if len(self.chain) - self.state_height >= STATE_INTERVAL:
+            self.save_state()
 
     def create_genesis_block(self):
-        genesis_block = Block(0, [], "0")
-        self.chain.append(genesis_block)
+        self.chain.append(genesis_block())
+
+    # Starts an empty node from a peer's signed snapshot instead of the whole history.
+    # The blocks after the snapshot are synced from that peer once the node is up.
+    def bootstrap(self, url):
+        if not SNAPSHOT_KEY:
+            raise ValueError("NODE_SNAPSHOT_KEY is needed to check the snapshot from NODE_BOOTSTRAP_URL")
+        path = SNAPSHOT_PATH + ".download"
+        try:
+            with requests.get(f"{url}/snapshot", timeout=SNAPSHOT_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                with open(path, "wb") as f:
+                    for data in response.iter_content(chunk_size=snapshot.READ_SIZE):
+                        f.write(data)
+            # Blocks are appended as they are checked, a bad snapshot leaves the log empty
+            try:
+                meta = snapshot.load(path, SNAPSHOT_KEY, schedule, genesis_block().hash, self.chain.append_payload)
+            except Exception:
+                self.chain.truncate(0)
+                raise
+            size = os.path.getsize(path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        self.save_pruned_height(len(self.chain))
+        app.logger.info(f"Bootstrapped from {url} at height {meta['height']} ({size} bytes)")
+
+    # Appends a block to the main chain and keeps the indexes, the block tree and the
+    # mempool in step. Raises ValueError, before anything is written, when its
+    # transactions cannot be confirmed on top of the current tip.
+    @synchronized
+    def connect_block(self, block):
+        self.check_block_transactions(block, len(self.chain) - 1)
+        size = self.chain.append(block)
+        try:
+            self.index.connect_block(block)
+            self.tree.add(block)
+        except Exception:
+            # The log must not hold a block the indexes and the tree do not know
+            self.index.disconnect_block(block)
+            self.chain.truncate(block.index)
+            raise
+        block_bytes.observe(size)
+        block_transactions.observe(len(block.transactions))
+        self.tree.side_blocks.pop(block.hash, None)
+        self.tree.tip = block.hash
+        self.tip_changed.set()
+        self.remove_pending(block.transactions)
+        events.publish("block_connected", {"index": block.index, "hash": block.hash, "tx_hashes": block.tx_hashes()})
+        if len(self.chain) - self.state_height >= STATE_INTERVAL:
+            self.save_state()
+        if PRUNE_DEPTH and len(self.chain) - PRUNE_DEPTH - self.pruned_height >= PRUNE_BATCH:
+            self.prune(len(self.chain) - PRUNE_DEPTH)
+
+    # Cuts the transactions of the blocks below `height` down to their file manifests
+    # where that saves space (see Block.to_pruned). Indexes and proofs keep working, the
+    # pruned blocks can no longer be served whole. The block log is rewritten only when
+    # some block actually shrinks; that rewrite copies the whole log under the chain lock.
+    @synchronized
+    def prune(self, height):
+        if height <= self.pruned_height:
+            return
+        start = time.perf_counter()
+        shrinking = [h for h in range(self.pruned_height, height) if self.chain[h].to_pruned() is not self.chain[h]]
+        if shrinking:
+            self.chain.rewrite(shrinking[0], shrinking[-1] + 1, Block.to_pruned)
+        app.logger.info(f"Pruned {len(shrinking)} of blocks {self.pruned_height} to {height - 1} "
+                        f"in {time.perf_counter() - start:.2f}s")
+        self.save_pruned_height(height)
+        # No reorg reaches below the pruned blocks, so the tree only needs the block they end on
+        self.tree.forget_below(height - 1)
+
+    # Blocks below the pruned height were all looked at, most may have stayed whole, so
+    # the height is kept in a file rather than read off the last pruned block
+    def load_pruned_height(self):
+        try:
+            with open(PRUNED_HEIGHT_PATH) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def save_pruned_height(self, height):
+        tmp_path = PRUNED_HEIGHT_PATH + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(height))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, PRUNED_HEIGHT_PATH)
+        self.pruned_height = height
+
+    # The indexes and the main chain nodes of the block tree are saved every STATE_INTERVAL
+    # blocks, so a restart only scans the blocks connected since. The file is the node's
+    # own, written next to the block log and pickled for speed. It is only used while the
+    # block it ends at is still at its height in the log; after a reorg below it, a
+    # truncated log or a change of NODE_ERASURE the indexes are rebuilt from the log.
+    def load_state(self):
+        # The state is millions of small objects, collecting while they are created only costs time
+        gc.disable()
+        try:
+            with open(STATE_PATH, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            app.logger.warning(f"Ignoring unreadable {STATE_PATH}: {str(e)}")
+            return 0
+        finally:
+            gc.enable()
+        if not isinstance(state, dict) or state.get("version") != STATE_VERSION \
+                or state.get("track_chunks") != bool(ERASURE) or not 0 < state["height"] <= len(self.chain):
+            return 0
+        height = state["height"]
+        header = codec.decode_header_record(codec.header_record(self.chain.head(height - 1, codec.HEADER_RECORD_SIZE + 1)))
+        if header["hash"] != state["tip"]:
+            return 0
+        self.index.load_state(state["index"])
+        self.tree.add_entries(state["tree"])
+        self.pruned_height = max(self.pruned_height, state["pruned_height"])
+        return height
+
+    @synchronized
+    def save_state(self):
+        start = time.perf_counter()
+        data = pickle.dumps({
+            "version": STATE_VERSION,
+            "height": len(self.chain),
+            "tip": self.tree.tip,
+            "track_chunks": bool(ERASURE),
+            "pruned_height": self.pruned_height,
+            "index": self.index.state(),
+            "tree": self.tree.entries(self.index.block_heights)
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path = STATE_PATH + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, STATE_PATH)
+        self.state_height = len(self.chain)
+        app.logger.info(f"Saved the chain state at height {self.state_height} ({len(data)} bytes) "
+                        f"in {time.perf_counter() - start:.2f}s")
+
+    # Path of a signed snapshot of the chain up to a height well below the tip, where
+    # reorgs do not reach. The height moves in steps, so one snapshot file is served for
+    # a while. It never ends below our pruned blocks, the node loading it fetches the
+    # rest from us. Only the height is picked under the chain lock, the file is streamed
+    # from the block log while blocks keep being accepted.
+    def snapshot_file(self):
+        with self.lock:
+            height = max(0, (len(self.chain) - 1 - MAX_SIDE_DEPTH) // SNAPSHOT_INTERVAL * SNAPSHOT_INTERVAL,
+                         self.pruned_height - 1)
+        with self._snapshot_lock:
+            if self._snapshot_height != height or not os.path.exists(SNAPSHOT_PATH):
+                self._snapshot_height = None
+                snapshot.write(SNAPSHOT_PATH, self.chain, height, SNAPSHOT_KEY)
+                self._snapshot_height = height
+        return SNAPSHOT_PATH
 
     @property
     def last_block(self):
         return self.chain[-1]
 
-    def new_transaction(self, transaction):
+    def is_pending(self, transaction):
+        return transaction_hash(transaction) in self.pending
+
+    def pending_by_hash(self, tx_hash):
+        return self.pending.get(tx_hash)
+
+    # Drops pending transactions that made it into a block
+    def remove_pending(self, transactions):
+        self.pending.remove(transaction_hash(tx) for tx in transactions)
+
+
+    # Under erasure coding the chunks of a relayed transaction stay on the nodes of its
+    # layout, so only the node it was submitted to checks them (check_chunks=False);
+    # relays check that they have the layout instead
+    @synchronized
+    def new_transaction(self, transaction, check_chunks=True):
         try:
-            if not isinstance(transaction, dict):
-                raise ValueError("Transaction must be a dictionary")
-                
-            required = ["user", "v_file", "file_data", "file_size"]
-            if not all(k in transaction for k in required):
-                missing = [k for k in required if k not in transaction]
-                raise ValueError(f"Missing required fields: {missing}")
-                
-            if not isinstance(transaction["file_data"], str):
-                raise ValueError("file_data must be a string (hex encoded)")
-                
-            try:
-                bytes.fromhex(transaction["file_data"])
-            except ValueError:
-                raise ValueError("file_data must be valid hex string")
+            check_transaction(transaction)
 
-            if not isinstance(transaction["file_size"], int) or transaction["file_size"] < 0:
-                raise ValueError("file_size must be a positive integer")
+            # A transaction is confirmed at most once, the index keeps one location per hash
+            location = self.index.locate(transaction_hash(transaction))
+            if location is not None:
+                raise ValueError(f"Transaction is already confirmed in block #{location[0]}")
 
-            self.pending.append(transaction)
+            if "ref_tx" in transaction:
+                self.check_reference(transaction)
+                self.accept_transaction(transaction)
+                return self.last_block.index + 1
+
+            # The file bytes live in the chunk store, only the manifest goes on chain
+            chunks = transaction["chunks"]
+            if check_chunks:
+                missing_chunks = chunk_store.missing(chunks)
+                if missing_chunks:
+                    raise ValueError(f"Missing chunks: {missing_chunks}")
+
+                if sum(chunk_store.size(c) for c in chunks) != transaction["file_size"]:
+                    raise ValueError("file_size does not match stored chunks")
+
+            self.accept_transaction(transaction)
             return self.last_block.index + 1
             
         except Exception as e:
+            transactions_rejected.inc()
             app.logger.error(f"Transaction validation failed: {str(e)}")
             raise
 
-    def mine(self):
+    def accept_transaction(self, transaction):
+        tx_hash = self.pending.add(transaction)
+        events.publish("tx_accepted", {"tx_hash": tx_hash, "user": transaction["user"], "v_file": transaction["v_file"]})
+
+    # A referencing transaction must point at a confirmed transaction that stored the same
+    # content. Checking a branch, transactions of main chain blocks above `base` do not
+    # count and those of the branch's earlier blocks (`branch`, by hash) do.
+    def check_reference(self, transaction, base=None, branch=None):
+        ref_tx = transaction["ref_tx"]
+        stored = branch.get(ref_tx) if branch else None
+        if stored is None:
+            location = self.index.locate(ref_tx)
+            if location is None or (base is not None and location[0] > base):
+                raise ValueError("ref_tx is not a confirmed transaction")
+            height, position = location
+            stored = self.chain[height].transactions[position]
+        # Pruning drops the chunk list, so whether the transaction stored content is told by its lack of ref_tx
+        if "ref_tx" in stored or stored.get("merkle_root") != transaction["merkle_root"] \
+                or stored.get("file_size") != transaction["file_size"]:
+            raise ValueError("ref_tx does not store this content")
+
+    # Raises ValueError unless the transactions of `block`, connected above height `base`,
+    # are each confirmed for the first time and only reference content confirmed before.
+    # `branch` collects the transactions of earlier blocks of the same branch. Their form
+    # was checked with the block body (validation.check_transactions).
+    def check_block_transactions(self, block, base, branch=None):
+        branch = {} if branch is None else branch
+        for tx_hash, tx in zip(block.tx_hashes(), block.transactions):
+            location = self.index.locate(tx_hash)
+            if tx_hash in branch or (location is not None and location[0] <= base):
+                raise ValueError(f"Block #{block.index} confirms transaction {tx_hash} again")
+            if "ref_tx" in tx:
+                self.check_reference(tx, base, branch)
+            branch[tx_hash] = tx
+
+    def mine(self, progress=None):
         if not self.pending:
             app.logger.info("No pending transactions to mine")
             return None
 
         try:
-            last_block = self.last_block
+            with self.lock:
+                self.tip_changed.clear()
+                last_block = self.last_block
+            # Transactions keep arriving while mining runs in the background, so seal a snapshot
+            # of the highest priority ones that fit in a block
+            transactions = self.pending.select(MAX_BLOCK_BYTES)
+            if not transactions:
+                app.logger.info("No pending transaction fits in a block")
+                return None
             new_block = Block(
                 index=last_block.index + 1,
-                transactions=self.pending,
-                previous_hash=last_block.hash
+                transactions=transactions,
+                previous_hash=last_block.hash,
+                timestamp=timestamp_after(last_block),
+                target=schedule.next_target(last_block, self.any_block)
             )
 
-            while not new_block.hash.startswith('00'):
-                new_block.nonce += 1
-                new_block.hash = new_block.compute_hash()
+            # A block from a peer that extends the chain makes this one stale, stop right away
+            result = mine_block(new_block, workers=MINING_WORKERS, progress=progress, cancel=self.tip_changed)
+            mining_hashes.inc(result.hashes)
+            mining_hash_rate.set(result.hash_rate)
+            mining_duration.observe(result.elapsed)
+            if not result.found and self.tip_changed.is_set():
+                app.logger.info(f"Stopped mining block #{new_block.index}, the chain moved on")
+                return None
+            if not result.found:
+                app.logger.error("Mining stopped before a valid nonce was found")
+                return None
 
-            self.chain.append(new_block)
-            self.pending = []
-            app.logger.info(f"Mined block #{new_block.index}")
+            # A block from a peer may have extended the chain while we were mining
+            with self.lock:
+                if self.last_block.hash != last_block.hash:
+                    app.logger.info(f"Discarding mined block #{new_block.index}, the chain moved on")
+                    return None
+                self.connect_block(new_block)
+            blocks_mined.inc()
+            app.logger.info(f"Mined block #{new_block.index} in {result.elapsed:.2f}s "
+                            f"({result.hash_rate:.0f} H/s on {result.workers} workers)")
             return new_block
             
         except Exception as e:
             app.logger.error(f"Mining failed: {str(e)}")
             return None
 
-    def add_block(self, block):
-        if not self.is_valid_block(block):
-            return False
-        self.chain.append(block)
-        return True
+    # Adds a block received from a peer to the block tree. It extends the main chain,
+    # starts or extends a side branch, or triggers a reorg when its branch has more work.
+    # Returns "known", "orphan" (parent unknown), "invalid", "connected", "side" or "reorg".
+    @synchronized
+    def accept_block(self, block):
+        if block.hash in self.tree:
+            return "known"
+        parent = self.any_block(block.previous_hash)
+        if parent is None:
+            return "orphan"
+        if block.previous_hash not in self.tree:
+            # Forks off below the pruned blocks, the node could never switch to it
+            return "invalid"
+        if validator.validate([block], parent) is None:
+            return "invalid"
 
-    def is_valid_block(self, block):
-        last_block = self.last_block
-        if block.index != last_block.index + 1:
-            return False
-        if block.previous_hash != last_block.hash:
-            return False
-        if block.compute_hash() != block.hash:
+        if block.previous_hash == self.tree.tip:
+            try:
+                self.connect_block(block)
+            except ValueError as e:
+                app.logger.warning(f"Rejected block #{block.index}: {str(e)}")
+                return "invalid"
+            return "connected"
+
+        self.tree.add_side_block(block)
+        if self.tree.heavier_than_tip(block.hash) and self.reorganize(block.hash):
+            return "reorg"
+        self.tree.prune()
+        # reorganize drops a branch whose transactions do not hold, prune one too deep or too light to keep
+        return "side" if block.hash in self.tree else "invalid"
+
+    # Switches the main chain to the branch ending at `new_tip`. Only the blocks above the
+    # fork point are undone and applied, so the cost is the fork depth, not the chain length.
+    @synchronized
+    def reorganize(self, new_tip):
+        ancestor = self.tree.common_ancestor(self.tree.tip, new_tip)
+        if ancestor is None or ancestor.height + 1 < self.pruned_height:
+            app.logger.warning(f"Not reorganizing below height {self.pruned_height}, the blocks there are pruned")
             return False
+        branch = [self.tree.side_blocks[h] for h in self.tree.path(ancestor.hash, new_tip)]
+
+        # Every block of the branch is checked against the chain as it will be before
+        # anything is undone, a bad block and its descendants are dropped
+        confirmed = {}
+        for block in branch:
+            try:
+                self.check_block_transactions(block, ancestor.height, confirmed)
+            except ValueError as e:
+                app.logger.warning(f"Not reorganizing to {new_tip}: {str(e)}")
+                self.tree.discard([block.hash])
+                return False
+
+        undone = len(self.chain) - 1 - ancestor.height
+        orphaned = []
+        for height in range(len(self.chain) - 1, ancestor.height, -1):
+            block = self.chain[height]
+            self.index.disconnect_block(block)
+            self.tree.side_blocks[block.hash] = block
+            orphaned.extend(block.transactions)
+            events.publish("block_disconnected", {"index": block.index, "hash": block.hash, "tx_hashes": block.tx_hashes()})
+        self.chain.truncate(ancestor.height + 1)
+        self.tree.tip = ancestor.hash
+        self.state_height = min(self.state_height, len(self.chain))
+
+        for block in branch:
+            self.connect_block(block)
+
+        # Transactions that only lived on the abandoned branch go back to the mempool
+        restored = 0
+        for tx in orphaned:
+            if self.index.locate(transaction_hash(tx)) is None:
+                try:
+                    self.pending.add(tx)
+                    restored += 1
+                except ValueError:
+                    pass
+        self.tree.prune()
+        app.logger.info(f"Reorganized at height {ancestor.height}: undid {undone} blocks, applied {len(branch)}, "
+                        f"{restored} transactions back in the mempool")
         return True
 
+    @synchronized
+    def find_block(self, block_hash):
+        height = self.index.height_of(block_hash)
+        return None if height is None else self.chain[height]
+
+    # Main chain or side branch block
+    @synchronized
+    def any_block(self, block_hash):
+        block = self.find_block(block_hash)
+        return block if block is not None else self.tree.side_blocks.get(block_hash)
+
+    @property
+    def total_work(self):
+        return self.tree.get(self.tree.tip).work
+
+# Expected hashes to find a block below its target
+def block_work(block):
+    return work_for(block.target)
+
+# Every node starts from this block
+def genesis_block():
+    return Block(0, [], GENESIS_PREVIOUS_HASH, timestamp=GENESIS_TIMESTAMP, target=schedule.initial_target)
+
 blockchain = Blockchain()
+validator = ChainValidator(schedule, lookup=blockchain.find_block, ancestors=blockchain.any_block, workers=VALIDATION_WORKERS)
+metrics.gauge("node_mempool_transactions", "Pending transactions", collect=lambda: len(blockchain.pending))
+metrics.gauge("node_mempool_bytes", "Encoded size of pending transactions", collect=lambda: blockchain.pending.bytes)
+metrics.gauge("node_chain_height", "Height of the chain tip", collect=lambda: len(blockchain.chain) - 1)
+metrics.gauge("node_peers", "Known peers", collect=lambda: len(known_peers()))
+metrics.gauge("node_pruned_height", "Blocks below this height are pruned", collect=lambda: blockchain.pruned_height)
+
+def block_summary(block):
+    return {
+        "message": "New Block Forged",
+        "index": block.index,
+        "transactions": [
+            {
+                "tx_hash": transaction_hash(tx),
+                "user": tx["user"],
+                "v_file": tx["v_file"],
+                "file_size": tx["file_size"]
+            } for tx in block.transactions
+        ],
+        "previous_hash": block.previous_hash,
+        "merkle_root": block.merkle_root,
+        "hash": block.hash,
+        "nonce": block.nonce,
+        "timestamp": block.timestamp
+    }
+
+def run_mining(progress):
+    mined_block = blockchain.mine(progress=progress)
+    if not mined_block:
+        return None
+    seen.add(f"block:{mined_block.hash}")
+    announce("block", [mined_block.hash])
+    return block_summary(mined_block)
+
+mining_jobs = MiningJobs(run_mining)
+auto_miner = AutoMiner(
+    mining_jobs,
+    lambda: (len(blockchain.pending), blockchain.pending.oldest()),
+    max_size=AUTO_MINE_SIZE,
+    max_age=AUTO_MINE_AGE
+)
+
+# Read routes see the chain between two changes, never in the middle of a reorg
+def chain_snapshot(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with blockchain.lock:
+            return view(*args, **kwargs)
+    return wrapper
+
+def known_peers():
+    with peers_lock:
+        return list(peers)
+
+# Blocks go out in the compact binary encoding to clients that ask for it with
+# `Accept: application/x-filestore-block` (peers do), JSON to everyone else
+def wants_binary():
+    return request.accept_mimetypes.best_match(["application/json", codec.BINARY_MIMETYPE]) == codec.BINARY_MIMETYPE
+
+def binary_response(data, headers=None):
+    response = app.response_class(data, mimetype=codec.BINARY_MIMETYPE, headers=headers)
+    response.vary.add("Accept")
+    return response
+
+def is_binary(response):
+    return response.headers.get("Content-Type", "").startswith(codec.BINARY_MIMETYPE)
 
 @app.route("/new_transaction", methods=["POST"])
 def new_transaction():
@@ -105,13 +630,26 @@ def new_transaction():
             
         tx = request.get_json()
         app.logger.info(f"Received transaction: {tx}")
-        
+
+        if isinstance(tx, dict) and blockchain.is_pending(tx):
+            return jsonify({"message": "Transaction already pending", "tx_hash": transaction_hash(tx)}), 200
+
         index = blockchain.new_transaction(tx)
-        broadcast_transaction(tx)  # <-- Broadcast to peers
+        tx_hash = transaction_hash(tx)
+        if ERASURE and "chunks" in tx:
+            # Peers only relay a file once its layout reached them, so place it first
+            try:
+                place_file(tx)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # The file stays whole on this node, nothing is lost
+                app.logger.warning(f"Could not place the shards of {tx['merkle_root']}: {str(e)}")
+        seen.add(f"tx:{tx_hash}")
+        announce("tx", [tx_hash])  # <-- Gossip to peers
 
         return jsonify({
             "message": "Transaction added",
             "block_index": index,
+            "tx_hash": tx_hash,
             "transaction": {
                 "user": tx["user"],
                 "v_file": tx["v_file"],
@@ -125,61 +663,366 @@ def new_transaction():
         app.logger.error(f"Transaction processing failed: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
-@app.route("/mine", methods=["GET"])
+@app.route("/mine", methods=["GET", "POST"])
 def mine():
-    mined_block = blockchain.mine()
-    if not mined_block:
+    if not blockchain.pending:
         return jsonify({
             "message": "No transactions to mine",
             "pending_count": len(blockchain.pending)
         }), 200
-    
+
+    # PoW runs in the background, the caller polls /mine/<job_id> for the block
+    job = mining_jobs.submit()
     return jsonify({
-        "message": "New Block Forged",
-        "index": mined_block.index,
-        "transactions": [
-            {
-                "user": tx["user"],
-                "v_file": tx["v_file"],
-                "file_size": tx["file_size"]
-            } for tx in mined_block.transactions
-        ],
-        "previous_hash": mined_block.previous_hash,
-        "hash": mined_block.hash,
-        "nonce": mined_block.nonce,
-        "timestamp": mined_block.timestamp
-    }), 200
+        "message": "Mining job started",
+        "job_id": job.id,
+        "status": job.status,
+        "pending_count": len(blockchain.pending)
+    }), 202
+
+@app.route("/mine/<job_id>", methods=["GET"])
+def mining_status(job_id):
+    job = mining_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Mining job not found"}), 404
+    return jsonify(job.to_dict())
 
 @app.route("/chain", methods=["GET"])
+@chain_snapshot
 def get_chain():
-    chain_data = []
-    for block in blockchain.chain:
-        block_data = {
-            "index": block.index,
-            "transactions": block.transactions,
-            "nonce": block.nonce,
-            "hash": block.hash,
-            "previous_hash": block.previous_hash,
-            "timestamp": block.timestamp
-        }
-        chain_data.append(block_data)
-    
+    length = len(blockchain.chain)
+    try:
+        from_index = max(0, int(request.args.get("from_index", 0)))
+        limit = request.args.get("limit")
+        limit = length if limit is None else min(max(0, int(limit)), MAX_CHAIN_PAGE)
+    except ValueError:
+        return jsonify({"error": "from_index and limit must be integers"}), 400
+    headers_only = request.args.get("headers_only", "").lower() in ("1", "true", "yes")
+    if headers_only:
+        return get_chain_headers(length, from_index, limit)
+
+    blocks = blockchain.chain[from_index:from_index + limit]
+    pruned = next((block for block in blocks if block.pruned), None)
+    if pruned is not None:
+        return jsonify({"error": f"Block #{pruned.index} is pruned, ask for headers_only"}), 410
+    if wants_binary():
+        return binary_response(
+            codec.encode_records([codec.encode_block(block) for block in blocks]),
+            {"X-Chain-Length": str(length), "X-From-Index": str(from_index)}
+        )
+    chain_data = [block.to_dict() for block in blocks]
+
     return jsonify({
-        "length": len(chain_data),
+        "length": length,
+        "from_index": from_index,
         "chain": chain_data
     })
 
+# Header records are cut straight out of the block log, no block is decoded or cached
+def get_chain_headers(length, from_index, limit):
+    records = [
+        codec.header_record(blockchain.chain.head(height, codec.HEADER_RECORD_SIZE + 1))
+        for height in range(from_index, min(length, from_index + limit))
+    ]
+    if wants_binary():
+        return binary_response(
+            codec.encode_records(records),
+            {"X-Chain-Length": str(length), "X-From-Index": str(from_index)}
+        )
+    headers = [codec.decode_header_record(record) for record in records]
+    for header in headers:
+        header["target"] = f"{header['target']:064x}"
+
+    return jsonify({
+        "length": length,
+        "from_index": from_index,
+        "chain": headers
+    })
+
+@app.route("/chain/tip", methods=["GET"])
+@chain_snapshot
+def get_chain_tip():
+    tip = blockchain.last_block
+    return jsonify({
+        "length": len(blockchain.chain),
+        "height": tip.index,
+        "hash": tip.hash,
+        "work": blockchain.total_work,
+        "target": f"{tip.target:064x}"
+    })
+
+@app.route("/proof/<int:block_index>/<int:tx_index>", methods=["GET"])
+@chain_snapshot
+def get_proof(block_index, tx_index):
+    if not 0 <= block_index < len(blockchain.chain):
+        return jsonify({"error": "Block not found"}), 404
+
+    block = blockchain.chain[block_index]
+    if not 0 <= tx_index < len(block.transactions):
+        return jsonify({"error": "Transaction not found"}), 404
+
+    return jsonify({
+        "block_index": block.index,
+        "block_hash": block.hash,
+        "merkle_root": block.merkle_root,
+        "tx_hash": block.tx_hashes()[tx_index],
+        "transaction": block.transactions[tx_index],
+        "pruned": block.summary_hashes()[tx_index] is not None,
+        "proof": block.merkle_proof(tx_index)
+    })
+
+def tx_location(tx_hash):
+    location = blockchain.index.locate(tx_hash)
+    if location is None:
+        return None
+    height, position = location
+    block = blockchain.chain[height]
+    return block, position
+
+@app.route("/tx/<tx_hash>", methods=["GET"])
+@chain_snapshot
+def get_transaction(tx_hash):
+    found = tx_location(tx_hash)
+    if found is None:
+        pending = blockchain.pending_by_hash(tx_hash)
+        if pending is None:
+            return jsonify({"error": "Transaction not found"}), 404
+        return jsonify({"tx_hash": tx_hash, "status": "pending", "transaction": pending})
+
+    block, position = found
+    return jsonify({
+        "tx_hash": tx_hash,
+        "status": "confirmed",
+        "block_index": block.index,
+        "block_hash": block.hash,
+        "position": position,
+        "confirmations": len(blockchain.chain) - block.index,
+        "transaction": block.transactions[position],
+        "pruned": block.summary_hashes()[position] is not None
+    })
+
+@app.route("/tx/<tx_hash>/proof", methods=["GET"])
+@chain_snapshot
+def get_transaction_proof(tx_hash):
+    found = tx_location(tx_hash)
+    if found is None:
+        return jsonify({"error": "Transaction not confirmed"}), 404
+
+    block, position = found
+    return jsonify({
+        "tx_hash": tx_hash,
+        "block_index": block.index,
+        "block_hash": block.hash,
+        "merkle_root": block.merkle_root,
+        "transaction": block.transactions[position],
+        "pruned": block.summary_hashes()[position] is not None,
+        "proof": block.merkle_proof(position)
+    })
+
+@app.route("/user/<user>/txs", methods=["GET"])
+@chain_snapshot
+def get_user_transactions(user):
+    return jsonify({
+        "user": user,
+        "transactions": [
+            {"tx_hash": tx_hash, "block_index": blockchain.index.locate(tx_hash)[0]}
+            for tx_hash in blockchain.index.transactions_of(user)
+        ]
+    })
+
+@app.route("/file/<content_hash>", methods=["GET"])
+@chain_snapshot
+def get_file_transactions(content_hash):
+    tx_hashes = blockchain.index.transactions_for_file(content_hash)
+    if not tx_hashes:
+        return jsonify({"error": "File not found on chain"}), 404
+    # The first confirmed transaction storing the content is what later uploads reference,
+    # pruned ones no longer list the chunks but still carry no ref_tx
+    def stores_chunks(tx_hash):
+        block, position = tx_location(tx_hash)
+        return "ref_tx" not in block.transactions[position]
+
+    stored_by = next((h for h in tx_hashes if stores_chunks(h)), None)
+    return jsonify({
+        "content_hash": content_hash,
+        "stored_by": stored_by,
+        "transactions": [
+            {"tx_hash": tx_hash, "block_index": blockchain.index.locate(tx_hash)[0]}
+            for tx_hash in tx_hashes
+        ]
+    })
+
 @app.route("/pending_tx", methods=["GET"])
 def get_pending_tx():
     return jsonify({
         "pending": [ {
+            "tx_hash": transaction_hash(tx),
             "user": tx["user"],
             "v_file": tx["v_file"],
             "file_size": tx["file_size"]
         } for tx in blockchain.pending ],
-        "count": len(blockchain.pending)
+        "count": len(blockchain.pending),
+        "bytes": blockchain.pending.bytes
     })
 
+@app.route("/chunks/<digest>", methods=["PUT"])
+def put_chunk(digest):
+    if not is_digest(digest):
+        return jsonify({"error": "Invalid chunk digest"}), 400
+
+    # Refuse oversized bodies before reading them, then read at most one chunk
+    if request.content_length is not None and request.content_length > chunk_store.chunk_size:
+        return jsonify({"error": f"Chunk larger than {chunk_store.chunk_size} bytes"}), 413
+    data = b""
+    while len(data) <= chunk_store.chunk_size:
+        part = request.stream.read(chunk_store.chunk_size + 1 - len(data))
+        if not part:
+            break
+        data += part
+    if len(data) > chunk_store.chunk_size:
+        return jsonify({"error": f"Chunk larger than {chunk_store.chunk_size} bytes"}), 413
+
+    try:
+        chunk_store.put(data, digest)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"message": "Chunk stored", "digest": digest}), 201
+
+@app.route("/chunks/<digest>", methods=["GET"])
+def get_chunk(digest):
+    if not is_digest(digest) or not chunk_store.has(digest):
+        return jsonify({"error": "Chunk not found"}), 404
+    # Chunks never change, their digest is the ETag and ranges are served from the file
+    response = send_file(chunk_store.path(digest), mimetype="application/octet-stream", add_etags=False)
+    response.set_etag(digest)
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    return response.make_conditional(request, accept_ranges=True, complete_length=chunk_store.size(digest))
+
+# ------------------------ ERASURE CODED STORAGE ------------------------
+# With NODE_ERASURE=k+m a file is not copied to every node. The node it is uploaded to
+# cuts it into stripes of k chunks, adds m parity shards per stripe and spreads the
+# k + m shards over the nodes a consistent hash ring picks for the stripe. Any k shards
+# of a stripe rebuild it, so up to m of its nodes can be lost. Every node gets the
+# layout saying which node holds which shard, readers fetch it from /shards.
+
+def place_file(tx):
+    # Content uploaded again keeps the shards it was placed with
+    existing = layouts.get(tx["merkle_root"])
+    if existing is not None and existing["file_size"] == tx["file_size"]:
+        release_chunks(existing)
+        return
+
+    k, m = ERASURE
+    ring = HashRing(known_peers() + [NODE_URL])
+    layout, parity = build_layout(tx["merkle_root"], tx["chunks"], tx["file_size"], chunk_store.get,
+                                  k, m, ring, chunk_store.chunk_size)
+    shards_by_node = {}
+    for stripe in layout["stripes"]:
+        for digest, node in zip(stripe["shards"], stripe["nodes"]):
+            if digest is not None:
+                shards_by_node.setdefault(node, set()).add(digest)
+
+    def store(node):
+        for digest in shards_by_node[node]:
+            data = parity[digest] if digest in parity else chunk_store.get(digest)
+            if node == NODE_URL:
+                chunk_store.put(data, digest)
+            else:
+                peer_client.request("PUT", node, f"/chunks/{digest}", data=data,
+                                    headers={"Content-Type": "application/octet-stream"}).raise_for_status()
+            shards_placed.inc()
+        return True
+
+    placed = {node for node, _ in peer_client.fan_out(shards_by_node, store)}
+    missed = set(shards_by_node) - placed
+    if missed:
+        raise ValueError(f"Shards could not be stored on {sorted(missed)}")
+
+    # A layout only goes out once all of its shards are stored, so a node that has
+    # one can rely on it. Peers fetch it back from here before storing it.
+    layouts.put(layout)
+
+    def send_layout(node):
+        peer_client.request("PUT", node, f"/shards/{layout['content_hash']}", json=layout,
+                            params={"origin": NODE_URL}).raise_for_status()
+        return True
+
+    peer_client.fan_out(known_peers(), send_layout)
+    release_chunks(layout)
+
+# Drops the chunks of a placed file that no layout assigns to this node. A chunk is
+# kept while a confirmed or pending manifest without a layout here lists it: files
+# stored before NODE_ERASURE was set, or whose placement failed, may share chunks
+# with this one and are only held as full copies.
+def release_chunks(layout):
+    # Rebuilt over pruned manifests, the chunk index cannot tell which files a chunk belongs to
+    if not blockchain.index.chunks_complete:
+        return
+    candidates = set(data_digests(layout)) - layouts.assigned
+    owners = {digest: set(blockchain.index.files_with_chunk(digest)) for digest in candidates}
+    with blockchain.lock:
+        for tx in blockchain.pending:
+            for digest in candidates.intersection(tx.get("chunks", ())):
+                owners[digest].add(tx.get("merkle_root"))
+    placed = {}
+    for digest in candidates:
+        for content_hash in owners[digest] - placed.keys():
+            placed[content_hash] = is_digest(content_hash) and layouts.get(content_hash) is not None
+        if all(placed[content_hash] for content_hash in owners[digest]):
+            chunk_store.remove(digest)
+
+@app.route("/shards/<content_hash>", methods=["PUT"])
+def put_layout(content_hash):
+    layout = request.get_json(silent=True)
+    if not isinstance(layout, dict) or layout.get("content_hash") != content_hash or not is_digest(content_hash):
+        return jsonify({"error": "Request must be the JSON layout of this content hash"}), 400
+    # Layouts decide which shards a node keeps, so only registered peers hand them out
+    # and the layout must be the one the peer itself serves
+    origin = request.args.get("origin")
+    if origin not in known_peers():
+        return jsonify({"error": "Unknown peer"}), 403
+    existing = layouts.get(content_hash)
+    if existing is not None and existing != layout:
+        return jsonify({"error": "Another layout is already stored for this content"}), 409
+    try:
+        response = peer_client.get(origin, f"/shards/{content_hash}")
+        response.raise_for_status()
+        served = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return jsonify({"error": "Layout could not be fetched back from the peer"}), 400
+    if served != layout:
+        return jsonify({"error": "Layout differs from the one the peer serves"}), 400
+
+    try:
+        stored = layouts.put(layout)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not stored:
+        return jsonify({"message": "Layout already stored", "content_hash": content_hash}), 200
+    return jsonify({"message": "Layout stored", "content_hash": content_hash}), 201
+
+@app.route("/shards/<content_hash>", methods=["GET"])
+def get_layout(content_hash):
+    layout = layouts.get(content_hash) if is_digest(content_hash) else None
+    if layout is None:
+        return jsonify({"error": "No layout for this content"}), 404
+    return jsonify(layout)
+
+@app.route("/events", methods=["GET"])
+def event_stream():
+    # EventSource clients resume with Last-Event-ID, others may pass ?last_id=
+    last_id = request.headers.get("Last-Event-ID", request.args.get("last_id"))
+    try:
+        last_id = int(last_id) if last_id is not None else None
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID must be an integer"}), 400
+    return Response(
+        events.stream(last_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ------------------------ PEER NETWORKING ------------------------
 
 @app.route('/register_peer', methods=['POST'])
@@ -189,50 +1032,233 @@ def register_peer():
         return jsonify({'error': 'Invalid peer data'}), 400
 
     peer = data['peer']
-    peers.add(peer)
-    return jsonify({'message': 'Peer added successfully', 'peers': list(peers)}), 201
+    url = urlsplit(peer) if isinstance(peer, str) else None
+    if url is None or url.scheme not in ("http", "https") or not url.netloc:
+        return jsonify({'error': 'Peer must be an http or https URL'}), 400
+    with peers_lock:
+        if peer in peers:
+            return jsonify({'message': 'Peer already registered', 'peers': list(peers)}), 200
+        if len(peers) >= MAX_PEERS:
+            return jsonify({'error': 'Peer limit reached'}), 403
+
+    # Only an address that answers as a node of this chain is registered
+    try:
+        response = requests.get(f"{peer}/chain", params={"limit": 1, "headers_only": 1}, timeout=PEER_TIMEOUT)
+        response.raise_for_status()
+        genesis = response.json()["chain"][0]["hash"]
+    except (requests.exceptions.RequestException, ValueError, LookupError, TypeError):
+        return jsonify({'error': 'Peer did not answer as a node'}), 400
+    if genesis != blockchain.chain[0].hash:
+        return jsonify({'error': 'Peer follows a different chain'}), 400
+
+    with peers_lock:
+        if peer not in peers and len(peers) >= MAX_PEERS:
+            return jsonify({'error': 'Peer limit reached'}), 403
+        peers.add(peer)
+    return jsonify({'message': 'Peer added successfully', 'peers': known_peers()}), 201
 
 @app.route('/peers', methods=['GET'])
 def get_peers():
-    return jsonify({'peers': list(peers)})
+    return jsonify({'peers': known_peers()})
 
-def broadcast_transaction(tx):
-    for peer in peers:
-        try:
-            requests.post(f"{peer}/new_transaction", json=tx)
-        except:
+# ------------------------ GOSSIP ------------------------
+# Nodes announce new transactions and blocks by hash to a few random peers.
+# A peer fetches only the items it has not seen yet and forwards the
+# announcement for those, so each item crosses every node once.
+
+def announce(kind, ids, exclude=()):
+    targets = choose_peers(known_peers(), GOSSIP_FANOUT, exclude)
+    if not targets:
+        return
+    inv = {"type": kind, "ids": ids, "origin": NODE_URL}
+    # Returns once BROADCAST_QUORUM peers answered, the remaining posts finish in the background
+    peer_client.fan_out(
+        targets,
+        lambda peer: peer_client.post(peer, "/inv", json=inv),
+        quorum=BROADCAST_QUORUM,
+        timeout=PEER_TIMEOUT
+    )
+
+def fetch_missing_chunks(origin, chunks):
+    for digest in chunk_store.missing(chunks):
+        response = peer_client.get(origin, f"/chunks/{digest}")
+        response.raise_for_status()
+        chunk_store.put(response.content, digest)
+
+def receive_transaction(origin, tx_hash):
+    if blockchain.pending_by_hash(tx_hash) is not None or blockchain.index.locate(tx_hash) is not None:
+        return False
+    response = peer_client.get(origin, f"/gossip/tx/{tx_hash}")
+    response.raise_for_status()
+    tx = response.json()
+    if transaction_hash(tx) != tx_hash:
+        raise ValueError(f"Peer {origin} sent a transaction that does not match {tx_hash}")
+
+    if not ERASURE:
+        fetch_missing_chunks(origin, tx.get("chunks", []))
+    elif "chunks" in tx:
+        # The origin sends the layout before announcing, once every shard is stored
+        layout = layouts.get(tx.get("merkle_root")) if is_digest(tx.get("merkle_root")) else None
+        if layout is None or layout["file_size"] != tx.get("file_size"):
+            raise ValueError(f"No complete layout for the file of {tx_hash}")
+    blockchain.new_transaction(tx, check_chunks=not ERASURE)
+    return True
+
+def receive_block(origin, block_hash):
+    if block_hash in blockchain.tree:
+        return False
+    response = peer_client.get(origin, f"/gossip/block/{block_hash}", headers={"Accept": codec.BINARY_MIMETYPE})
+    response.raise_for_status()
+    block = Block.from_bytes(response.content) if is_binary(response) else Block(**response.json())
+    if block.hash != block_hash:
+        raise ValueError(f"Peer {origin} sent a block that does not match {block_hash}")
+
+    status = blockchain.accept_block(block)
+    if status == "orphan":
+        # We are missing the blocks in between, catch up from the announcing peer
+        return sync_from(origin, block.index + 1)
+    return status in ("connected", "side", "reorg")
+
+@app.route("/inv", methods=["POST"])
+def inventory():
+    data = request.get_json(silent=True) or {}
+    kind, ids, origin = data.get("type"), data.get("ids"), data.get("origin")
+    if kind not in ("tx", "block") or not isinstance(ids, list) or not origin:
+        return jsonify({"error": "Invalid inventory"}), 400
+    # Items are fetched back from the origin, so it must be a peer we registered
+    if origin not in known_peers():
+        return jsonify({"error": "Unknown peer"}), 403
+
+    receive = receive_transaction if kind == "tx" else receive_block
+    fetched = []
+    for item_id in ids:
+        # Mark before fetching so concurrent announcements of the same item are dropped
+        if not is_digest(item_id) or not seen.add(f"{kind}:{item_id}"):
             continue
+        try:
+            accepted = receive(origin, item_id)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            app.logger.warning(f"Could not fetch {kind} {item_id} from {origin}: {str(e)}")
+            accepted = False
+        if accepted:
+            fetched.append(item_id)
+        else:
+            seen.discard(f"{kind}:{item_id}")
+
+    if fetched:
+        announce(kind, fetched, exclude={origin})
+    return jsonify({"fetched": fetched})
+
+@app.route("/gossip/tx/<tx_hash>", methods=["GET"])
+def gossip_transaction(tx_hash):
+    tx = blockchain.pending_by_hash(tx_hash)
+    if tx is None:
+        return jsonify({"error": "Transaction not found"}), 404
+    return jsonify(tx)
+
+@app.route("/gossip/block/<block_hash>", methods=["GET"])
+@chain_snapshot
+def gossip_block(block_hash):
+    block = blockchain.find_block(block_hash)
+    if block is None:
+        return jsonify({"error": "Block not found"}), 404
+    if block.pruned:
+        return jsonify({"error": "Block is pruned"}), 410
+    if wants_binary():
+        return binary_response(block.to_bytes())
+    return jsonify(block.to_dict())
 
-def valid_chain(chain):
-    for i in range(1, len(chain)):
-        prev = chain[i - 1]
-        curr = chain[i]
-        if curr['previous_hash'] != prev['hash']:
+# Header dicts when `headers_only`, Blocks otherwise
+def fetch_chain_page(peer, from_index, limit, headers_only=False):
+    params = {"from_index": from_index, "limit": limit}
+    if headers_only:
+        params["headers_only"] = 1
+    response = peer_client.get(peer, "/chain", params=params, headers={"Accept": codec.BINARY_MIMETYPE})
+    response.raise_for_status()
+    if is_binary(response):
+        decode = codec.decode_header_record if headers_only else Block.from_bytes
+        return [decode(record) for record in codec.decode_records(response.content)]
+    page = response.json()["chain"]
+    return page if headers_only else [Block(**blk) for blk in page]
+
+# Height of the last block we share with `peer`, walking back from our tip one page
+# of headers at a time. -1 means not even the genesis block matches.
+def find_common_ancestor(peer, peer_length):
+    height = min(len(blockchain.chain), peer_length) - 1
+    while height >= 0:
+        start = max(0, height - SYNC_PAGE + 1)
+        headers = fetch_chain_page(peer, start, height - start + 1, headers_only=True)
+        for header in reversed(headers):
+            if header["hash"] == blockchain.chain[header["index"]].hash:
+                return header["index"]
+        height = start - 1
+    return -1
+
+# Downloads only the blocks after the fork point and swaps them in if they are valid
+def sync_from(peer, peer_length):
+    ancestor = find_common_ancestor(peer, peer_length)
+    if ancestor < 0:
+        app.logger.warning(f"{peer} does not share our genesis block")
+        return False
+    if ancestor + 1 < blockchain.pruned_height:
+        app.logger.warning(f"{peer} forks off at height {ancestor}, below our pruned blocks")
+        return False
+
+    # Blocks up to the fork point are ours and already valid, only the ones after it
+    # are checked, page by page as they arrive so a bad chain is dropped early
+    parent = blockchain.chain[ancestor]
+    new_blocks = []
+    while ancestor + 1 + len(new_blocks) < peer_length:
+        page = fetch_chain_page(peer, ancestor + 1 + len(new_blocks), SYNC_PAGE)
+        if not page:
+            break
+        validated = validator.validate(page, parent)
+        if validated is None:
+            app.logger.warning(f"Rejected invalid chain from {peer}")
             return False
-        if sha256(json.dumps(curr, sort_keys=True).encode()).hexdigest() != curr['hash']:
+        # Keep the branch in the block tree as it arrives, later pages retarget against it
+        with blockchain.lock:
+            if parent.hash not in blockchain.tree:
+                app.logger.warning(f"Branch from {peer} was pruned while syncing it")
+                return False
+            for block in validated:
+                if blockchain.find_block(block.hash) is None:
+                    blockchain.tree.add_side_block(block)
+        new_blocks.extend(validated)
+        parent = validated[-1]
+
+    if not new_blocks:
+        return False
+
+    # Switch to the branch only if it carries more work, a branch we do not switch to is not kept
+    with blockchain.lock:
+        if new_blocks[-1].hash not in blockchain.tree or not blockchain.tree.heavier_than_tip(new_blocks[-1].hash) \
+                or not blockchain.reorganize(new_blocks[-1].hash):
+            blockchain.tree.discard(block.hash for block in new_blocks)
             return False
+    app.logger.info(f"Synced {len(new_blocks)} blocks from {peer} after height {ancestor}")
     return True
 
 def resolve_conflicts():
-    global blockchain
-    max_length = len(blockchain.chain)
-    new_chain = None
+    def fetch_tip(peer):
+        response = peer_client.get(peer, "/chain/tip")
+        response.raise_for_status()
+        tip = response.json()
+        return tip["work"], tip["length"]
 
-    for peer in peers:
-        try:
-            response = requests.get(f'{peer}/chain')
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-                if length > max_length and valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-        except:
-            continue
+    # Ask every peer at once, a slow peer costs at most one timeout
+    tips = [(work, length, peer) for peer, (work, length) in
+            peer_client.fan_out(known_peers(), fetch_tip, timeout=PEER_TIMEOUT)]
 
-    if new_chain:
-        blockchain.chain = [Block(**blk) for blk in new_chain]
-        return True
+    # Try the heaviest chains first, only their tips have been downloaded so far
+    for work, length, peer in sorted(tips, reverse=True):
+        if work <= blockchain.total_work:
+            break
+        try:
+            if sync_from(peer, length):
+                return True
+        except requests.exceptions.RequestException as e:
+            app.logger.warning(f"Sync from {peer} failed: {str(e)}")
     return False
 
 @app.route('/resolve', methods=['GET'])
@@ -243,7 +1269,42 @@ def consensus():
         "length": len(blockchain.chain)
     })
 
+@app.route("/snapshot", methods=["GET"])
+def get_snapshot():
+    if not SNAPSHOT_KEY:
+        return jsonify({"error": "Snapshots are off, set NODE_SNAPSHOT_KEY to enable them"}), 404
+    try:
+        path = blockchain.snapshot_file()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 503
+    return send_file(os.path.abspath(path), mimetype="application/octet-stream")
+
+# ------------------------ MONITORING ------------------------
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+# Collapsed stacks sampled since start-up (or the last ?reset=1), for flame graph tools
+@app.route("/debug/profile", methods=["GET"])
+def get_profile():
+    if not profiler.enabled:
+        return jsonify({"error": "Profiler is off, set NODE_PROFILE_INTERVAL to enable it"}), 404
+    return Response(profiler.collapsed(reset=request.args.get("reset") == "1"), mimetype="text/plain")
+
+# Background work, started once the node serves requests
+def start_node():
+    auto_miner.start()
+    profiler.start()
+    if BOOTSTRAP_URL:
+        # A snapshot ends some way below the tip, the rest comes from the node that served it
+        with peers_lock:
+            peers.add(BOOTSTRAP_URL)
+        threading.Thread(target=resolve_conflicts, daemon=True).start()
+
 # ----------------------------------------------------------------
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8800, debug=True)
+    start_node()
+    # Development server; see wsgi.py for serving. The reloader would open the block log twice
+    app.run(host="0.0.0.0", port=NODE_PORT, debug=NODE_DEBUG, use_reloader=False, threaded=True)
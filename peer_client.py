@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 5  # seconds, per request
+FAN_OUT_WORKERS = 16  # concurrent peer calls
+POOL_SIZE = 4  # keep-alive connections per peer
+
+
+# Talks to other nodes over one pooled keep-alive session per peer and runs
+# calls to many peers concurrently. `observe(peer, seconds, ok)`, when given, is
+# called after every call with its round trip time and whether it got a response.
+class PeerClient:
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_workers=FAN_OUT_WORKERS, pool_size=POOL_SIZE, observe=None):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.observe = observe
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="peer-client")
+
+    def session(self, peer):
+        with self._lock:
+            session = self._sessions.get(peer)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[peer] = session
+            return session
+
+    def forget(self, peer):
+        with self._lock:
+            session = self._sessions.pop(peer, None)
+        if session is not None:
+            session.close()
+
+    def request(self, method, peer, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session(peer).request(method, f"{peer}{path}", **kwargs)
+        except requests.exceptions.RequestException:
+            if self.observe:
+                self.observe(peer, time.perf_counter() - start, False)
+            raise
+        if self.observe:
+            self.observe(peer, time.perf_counter() - start, True)
+        return response
+
+    def get(self, peer, path, **kwargs):
+        return self.request("GET", peer, path, **kwargs)
+
+    def post(self, peer, path, **kwargs):
+        return self.request("POST", peer, path, **kwargs)
+
+    # Runs call(peer) for every peer concurrently and returns [(peer, result)] for the
+    # calls that succeeded. Returns early once `quorum` calls have succeeded (None waits
+    # for all of them) or after `timeout` seconds; unfinished calls keep running.
+    def fan_out(self, peers, call, quorum=None, timeout=None):
+        futures = {self._executor.submit(call, peer): peer for peer in peers}
+        if quorum is not None:
+            quorum = min(quorum, len(futures))
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = []
+        pending = set(futures)
+        while pending and (quorum is None or len(results) < quorum):
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                peer = futures[future]
+                try:
+                    results.append((peer, future.result()))
+                except Exception as e:
+                    logger.warning(f"Call to peer {peer} failed: {str(e)}")
+        return results
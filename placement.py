@@ -0,0 +1,199 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+import requests
+import erasure
+from chunk_store import CHUNK_SIZE, is_digest
+from merkle import merkle_root
+
+VIRTUAL_NODES = 64  # points per node on the ring, evens out the share each node gets
+FETCH_WORKERS = 8  # shards downloaded at once
+FETCH_TIMEOUT = 10  # seconds per shard
+
+
+def ring_position(key):
+    return int.from_bytes(sha256(key.encode()).digest()[:8], "big")
+
+
+# Consistent hashing over node URLs. A key goes to the nodes met walking clockwise
+# from its position, so adding or removing a node only moves the keys next to it.
+class HashRing:
+    def __init__(self, nodes, vnodes=VIRTUAL_NODES):
+        self.nodes = sorted(set(nodes))
+        self._ring = sorted((ring_position(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._positions = [position for position, _ in self._ring]
+
+    # `count` nodes for `key`, all distinct while there are enough nodes; with fewer
+    # nodes than shards the walk goes round again and nodes get several shards
+    def nodes_for(self, key, count):
+        if not self._ring:
+            raise ValueError("No nodes to place shards on")
+        start = bisect.bisect(self._positions, ring_position(key))
+        distinct = []
+        for i in range(len(self._ring)):
+            node = self._ring[(start + i) % len(self._ring)][1]
+            if node not in distinct:
+                distinct.append(node)
+                if len(distinct) == len(self.nodes):
+                    break
+        return [distinct[i % len(distinct)] for i in range(count)]
+
+
+# A file is cut into stripes of k consecutive chunks. The chunks themselves are the
+# data shards, so the digests on chain still address them, and each stripe gets m
+# parity shards, stored as chunks of their own. A short last stripe is padded with
+# zero shards that are never stored (None in the layout). Returns the layout and the
+# parity chunks by digest.
+def build_layout(content_hash, digests, file_size, read_chunk, k, m, ring, chunk_size=CHUNK_SIZE):
+    layout = {
+        "content_hash": content_hash,
+        "file_size": file_size,
+        "chunk_size": chunk_size,
+        "k": k,
+        "m": m,
+        "stripes": []
+    }
+    parity_chunks = {}
+    for start in range(0, len(digests), k):
+        group = digests[start:start + k]
+        data = [read_chunk(digest) for digest in group]
+        size = max(len(chunk) for chunk in data)
+        padded = [chunk.ljust(size, b"\0") for chunk in data] + [bytes(size)] * (k - len(group))
+        parity = erasure.encode(padded, m)
+        parity_digests = [sha256(chunk).hexdigest() for chunk in parity]
+        parity_chunks.update(zip(parity_digests, parity))
+        layout["stripes"].append({
+            "size": size,
+            "shards": group + [None] * (k - len(group)) + parity_digests,
+            "nodes": ring.nodes_for(f"{content_hash}:{len(layout['stripes'])}", k + m)
+        })
+    return layout, parity_chunks
+
+
+def data_digests(layout):
+    k = layout["k"]
+    return [digest for stripe in layout["stripes"] for digest in stripe["shards"][:k] if digest is not None]
+
+
+# Raises ValueError unless `layout` is well formed and lists the chunks of its content hash
+def check_layout(layout):
+    try:
+        k, m = layout["k"], layout["m"]
+        stripes = layout["stripes"]
+        erasure.generator(k, m)
+        for stripe in stripes:
+            shards, nodes = stripe["shards"], stripe["nodes"]
+            if len(shards) != k + m or len(nodes) != k + m or not isinstance(stripe["size"], int):
+                raise ValueError("Stripe does not have k + m shards")
+            if not all(is_digest(d) for d in shards[k:]) or not all(d is None or is_digest(d) for d in shards[:k]):
+                raise ValueError("Shards must be sha256 hex digests")
+        digests = data_digests(layout)
+        if merkle_root(digests) != layout["content_hash"]:
+            raise ValueError("Data shards do not match the content hash")
+        if -(-layout["file_size"] // layout["chunk_size"]) != len(digests):
+            raise ValueError("file_size does not match the number of chunks")
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed layout: {str(e)}")
+
+
+# Layouts known to this node, one JSON file per content hash, and the set of
+# chunks they assign to `node_url`, which the node must keep
+class LayoutStore:
+    def __init__(self, root, node_url):
+        self.root = root
+        self.node_url = node_url
+        self.assigned = set()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        for name in os.listdir(root):
+            if is_digest(name):
+                self._assign(self.get(name))
+
+    def path(self, content_hash):
+        if not is_digest(content_hash):
+            raise ValueError(f"Invalid content hash: {content_hash!r}")
+        return os.path.join(self.root, content_hash)
+
+    def _assign(self, layout):
+        for stripe in layout["stripes"]:
+            self.assigned.update(d for d, node in zip(stripe["shards"], stripe["nodes"])
+                                 if d is not None and node == self.node_url)
+
+    def get(self, content_hash):
+        try:
+            with open(self.path(content_hash)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # Stores a new layout and returns True, or False when the same layout is already
+    # stored. A stored layout is never replaced, so the shards `assigned` to this node
+    # from it stay assigned for as long as the node runs.
+    def put(self, layout):
+        check_layout(layout)
+        with self._lock:
+            existing = self.get(layout["content_hash"])
+            if existing is not None:
+                if existing != layout:
+                    raise ValueError(f"Another layout is already stored for {layout['content_hash']}")
+                return False
+            fd, tmp_path = tempfile.mkstemp(dir=self.root)
+            with os.fdopen(fd, "w") as f:
+                json.dump(layout, f)
+            os.replace(tmp_path, self.path(layout["content_hash"]))
+            self._assign(layout)
+        return True
+
+
+# Reads a file back from the nodes of its layout. The data chunks of a stripe are
+# fetched in parallel from their nodes; when some are missing, the parity shards are
+# fetched and any k shards rebuild the stripe. Every shard is checked against its
+# digest, so a node can withhold data but not alter it.
+class ShardClient:
+    def __init__(self, session=None, workers=FETCH_WORKERS, timeout=FETCH_TIMEOUT):
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard-client")
+
+    def fetch_shard(self, node, digest):
+        try:
+            response = self.session.get(f"{node}/chunks/{digest}", timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            return None
+        if response.status_code != 200 or sha256(response.content).hexdigest() != digest:
+            return None
+        return response.content
+
+    def _fetch(self, stripe, positions):
+        futures = {i: self._executor.submit(self.fetch_shard, stripe["nodes"][i], stripe["shards"][i])
+                   for i in positions}
+        results = {i: future.result() for i, future in futures.items()}
+        return {i: shard for i, shard in results.items() if shard is not None}
+
+    # The data chunks of stripe number `number`, without padding
+    def read_stripe(self, layout, number):
+        k, m = layout["k"], layout["m"]
+        stripe = layout["stripes"][number]
+        lengths = [min(layout["chunk_size"], layout["file_size"] - (number * k + i) * layout["chunk_size"])
+                   for i in range(k) if stripe["shards"][i] is not None]
+
+        shards = self._fetch(stripe, range(len(lengths)))
+        if len(shards) < len(lengths):
+            shards.update(self._fetch(stripe, range(k, k + m)))
+            for i in range(len(lengths), k):
+                shards[i] = bytes(stripe["size"])
+            if len(shards) < k:
+                raise ValueError(f"Only {len(shards)} of the {k} shards needed for stripe {number} are available")
+            shards = {i: shard.ljust(stripe["size"], b"\0") for i, shard in shards.items()}
+            shards = dict(enumerate(erasure.decode(shards, k, m)))
+        return [shards[i][:length] for i, length in enumerate(lengths)]
+
+    # Yields the file's chunks in order
+    def iter_file(self, layout):
+        check_layout(layout)
+        for number in range(len(layout["stripes"])):
+            yield from self.read_stripe(layout, number)
@@ -0,0 +1,136 @@
+import collections
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import time
+import codec
+from Block import Block
+from merkle import merkle_root
+from validation import check_header, check_context
+
+# Signed state snapshots a fresh node starts from instead of downloading the whole
+# history. A snapshot holds every block up to its height, pruned where that makes it
+# smaller (see Block.to_pruned): headers, transaction hashes and file manifests, from
+# which the node rebuilds its indexes. It is signed with HMAC-SHA256 under a key
+# shared by the nodes of one operator. Snapshots are written and loaded one record
+# at a time, neither side holds a whole one in memory.
+
+SNAPSHOT_VERSION = 2
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+READ_SIZE = 1024 * 1024  # bytes hashed per read when checking a signature
+
+
+def _header(record):
+    return codec.decode_header_record(codec.header_record(record))
+
+
+# Records of blocks 0 .. height of the block log, cut down where pruning makes them smaller
+def _records(log, height):
+    for payload in log.payloads(0, height + 1):
+        if payload[0] != codec.PRUNED_RECORD:
+            block = Block.from_bytes(payload)
+            pruned = block.to_pruned()
+            if pruned is not block:
+                payload = pruned.to_bytes()
+        yield payload
+
+
+# Writes the snapshot of blocks 0 .. height of the block log `log` to `path`: the
+# record count, JSON metadata and one record per block, as codec.encode_records lays
+# them out, then the signature of all of it. The file is written beside `path` and
+# renamed over it. Raises ValueError when the blocks read do not link up, as when a
+# reorg replaced some of them meanwhile.
+def write(path, log, height, key):
+    tip = _header(log.head(height, codec.HEADER_RECORD_SIZE + 1))
+    meta = {"version": SNAPSHOT_VERSION, "height": height, "tip": tip["hash"], "created": time.time()}
+    mac = hmac.new(key, digestmod=hashlib.sha256)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            def put(record):
+                data = codec.U32.pack(len(record)) + record
+                mac.update(data)
+                out.write(data)
+
+            count = codec.U32.pack(height + 2)
+            mac.update(count)
+            out.write(count)
+            put(json.dumps(meta, sort_keys=True).encode())
+            previous = None
+            for index, record in enumerate(_records(log, height)):
+                header = _header(record)
+                if header["index"] != index or (previous is not None and header["previous_hash"] != previous):
+                    raise ValueError("The chain changed while its snapshot was written")
+                previous = header["hash"]
+                put(record)
+            if previous != tip["hash"]:
+                raise ValueError("The chain changed while its snapshot was written")
+            out.write(mac.digest())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_record(f):
+    data = f.read(codec.U32.size)
+    if len(data) != codec.U32.size:
+        raise ValueError("Snapshot is truncated")
+    length, = codec.U32.unpack(data)
+    record = f.read(length)
+    if len(record) != length:
+        raise ValueError("Snapshot is truncated")
+    return record
+
+
+# Checks the snapshot in the file at `path` and passes each block record, once checked,
+# to `append`; returns the metadata. The signature says who made it; the blocks are
+# still checked as a chain, which is cheap without bodies: linkage from our genesis
+# block, proof of work, retargets and each Merkle root against the transaction hashes,
+# read from the records without decoding a transaction.
+def load(path, key, schedule, genesis_hash, append):
+    size = os.path.getsize(path)
+    if size < codec.U32.size + SIGNATURE_SIZE:
+        raise ValueError("Snapshot is truncated")
+    with open(path, "rb") as f:
+        mac = hmac.new(key, digestmod=hashlib.sha256)
+        remaining = size - SIGNATURE_SIZE
+        while remaining:
+            data = f.read(min(READ_SIZE, remaining))
+            mac.update(data)
+            remaining -= len(data)
+        if not hmac.compare_digest(f.read(), mac.digest()):
+            raise ValueError("Snapshot signature does not match")
+
+        f.seek(0)
+        count, = codec.U32.unpack(f.read(codec.U32.size))
+        meta = json.loads(_read_record(f))
+        if meta.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {meta.get('version')}")
+
+        # Retargets look back at most one interval, only that many headers are kept
+        window = collections.deque(maxlen=schedule.interval + 1)
+        get_block = lambda block_hash: next((b for b in window if b.hash == block_hash), None)
+        for _ in range(count - 1):
+            record = _read_record(f)
+            header, _, entries = codec.scan_block(record)
+            block = Block(transactions=[], **header)
+            tx_hashes = [entry[0] for entry in entries]
+            parent = window[-1] if window else None
+            if parent is None:
+                valid = block.hash == genesis_hash
+            else:
+                valid = block.index == parent.index + 1 and block.previous_hash == parent.hash \
+                    and check_header(block) and check_context(block, parent, schedule, get_block)
+            if not valid or merkle_root(tx_hashes) != block.merkle_root or len(set(tx_hashes)) != len(tx_hashes):
+                raise ValueError(f"Snapshot block #{block.index} is invalid")
+            append(record)
+            window.append(block)
+
+    if not window:
+        raise ValueError("Snapshot does not start at our genesis block")
+    if window[-1].index != meta["height"] or window[-1].hash != meta["tip"]:
+        raise ValueError("Snapshot does not end at the tip it claims")
+    return meta
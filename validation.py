@@ -0,0 +1,140 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from Block import Block, GENESIS_PREVIOUS_HASH
+from chunk_store import is_digest
+from difficulty import meets_target, valid_timestamp
+from merkle import merkle_root
+
+PARALLEL_THRESHOLD = 64  # blocks in a segment before body checks go to a process pool
+
+
+# Hash and proof of work against the target the block claims
+def check_header(block):
+    if block.index == 0:
+        # Genesis blocks are not mined
+        return block.previous_hash == GENESIS_PREVIOUS_HASH and block.compute_hash() == block.hash
+    return block.compute_hash() == block.hash and meets_target(block.hash, block.target)
+
+
+# Whether the claimed target and timestamp are the ones the schedule allows after `parent`
+def check_context(block, parent, schedule, get_block):
+    try:
+        expected = schedule.next_target(parent, get_block)
+    except KeyError:
+        return False
+    return block.target == expected and valid_timestamp(block, parent)
+
+
+# Pruned blocks are never accepted from the network, their bodies are gone. A Merkle
+# level pairs an odd last node with itself, so a body with its last transaction
+# repeated has the same root; blocks listing a transaction twice are rejected.
+def check_body(block):
+    if block.pruned or block.compute_merkle_root() != block.merkle_root:
+        return False
+    tx_hashes = block.tx_hashes()
+    return len(set(tx_hashes)) == len(tx_hashes)
+
+
+# The rules a file transaction follows wherever it comes from, a client or a peer's
+# block. Raises ValueError. Whether its chunks are stored, whether it is already
+# confirmed and what its ref_tx points at depend on the node and are checked there.
+def check_transaction(tx):
+    if not isinstance(tx, dict):
+        raise ValueError("Transaction must be a dictionary")
+
+    # Content already on chain is referenced through the transaction that stored it
+    is_ref = "ref_tx" in tx
+    required = ["user", "v_file", "file_size", "merkle_root"] + (["ref_tx"] if is_ref else ["chunks"])
+    missing = [k for k in required if k not in tx]
+    if missing:
+        raise ValueError(f"Missing required fields: {missing}")
+
+    if not isinstance(tx["user"], str) or not isinstance(tx["v_file"], str):
+        raise ValueError("user and v_file must be strings")
+    if not isinstance(tx["file_size"], int) or tx["file_size"] < 0:
+        raise ValueError("file_size must be a positive integer")
+    if not is_digest(tx["merkle_root"]):
+        raise ValueError("merkle_root must be a sha256 hex digest")
+
+    if is_ref:
+        if "chunks" in tx:
+            raise ValueError("A transaction with ref_tx carries no chunks")
+        if not is_digest(tx["ref_tx"]):
+            raise ValueError("ref_tx must be a sha256 hex digest")
+        return
+
+    chunks = tx["chunks"]
+    if not isinstance(chunks, list) or not all(is_digest(c) for c in chunks):
+        raise ValueError("chunks must be a list of sha256 hex digests")
+    if merkle_root(chunks) != tx["merkle_root"]:
+        raise ValueError("merkle_root does not match chunks")
+
+
+def check_transactions(block):
+    try:
+        for tx in block.transactions:
+            check_transaction(tx)
+    except ValueError:
+        return False
+    return True
+
+
+def _check_body_bytes(data):
+    block = Block.from_bytes(data)
+    return check_body(block) and check_transactions(block)
+
+
+# Validates chain segments incrementally. Headers (linkage, target and proof of work)
+# are checked first since they are cheap, then the transaction bodies against their
+# Merkle roots and check_transaction. Blocks the node already holds are taken from `lookup` instead of
+# being checked again, so only blocks past the fork point cost anything. `ancestors`
+# finds earlier blocks of a branch (main chain or side) for retargeting.
+class ChainValidator:
+    def __init__(self, schedule, lookup=None, ancestors=None, workers=None, parallel_threshold=PARALLEL_THRESHOLD):
+        self.schedule = schedule
+        self.lookup = lookup or (lambda block_hash: None)
+        self.ancestors = ancestors or self.lookup
+        self.workers = workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self._pool = None
+
+    # Returns the validated blocks, with known ones replaced by the local copy, or
+    # None if the segment is invalid or does not extend `parent` (a Block or None).
+    def validate(self, blocks, parent=None):
+        validated = []
+        unknown = []
+        segment = {}
+        previous = parent
+
+        def get_block(block_hash):
+            block = segment.get(block_hash)
+            return block if block is not None else self.ancestors(block_hash)
+
+        for block in blocks:
+            if previous is not None and (block.previous_hash != previous.hash or block.index != previous.index + 1):
+                return None
+            known = self.lookup(block.hash)
+            if known is not None:
+                block = known
+            else:
+                if not check_header(block):
+                    return None
+                if previous is not None and not check_context(block, previous, self.schedule, get_block):
+                    return None
+                unknown.append(block)
+            validated.append(block)
+            segment[block.hash] = block
+            previous = block
+
+        if not all(self._check_bodies(unknown)):
+            return None
+        return validated
+
+    def _check_bodies(self, blocks):
+        if self.workers <= 1 or len(blocks) < self.parallel_threshold:
+            return [check_body(block) and check_transactions(block) for block in blocks]
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        chunksize = max(1, len(blocks) // (self.workers * 4))
+        return list(self._pool.map(_check_body_bytes, [b.to_bytes() for b in blocks], chunksize=chunksize))
@@ -0,0 +1,11 @@
+# Production entry point for the node:
+#
+#     gunicorn --workers 1 --threads 8 --bind 0.0.0.0:8800 wsgi:app
+#
+# The chain, mempool and block log live in this process and are shared between
+# request threads under the chain lock, so scale with --threads. Several worker
+# processes would each open the same block log and keep diverging copies of the
+# chain, so keep --workers at 1 and run more nodes for more processes.
+from peer import app, start_node
+
+start_node()